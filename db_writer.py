@@ -0,0 +1,331 @@
+# Background MySQL writer shared by the collectors.
+#
+# Rows are queued in memory and flushed by a worker thread with one
+# executemany per table, either once batch_rows are waiting or every
+# flush_interval seconds. Every flush is a single transaction on a
+# long-lived connection. Callers never block on the database.
+#
+# A collector that works in rounds can pass batch_rounds and call
+# end_round() after queueing each round instead. Flushes then happen every
+# batch_rounds rounds and only ever take whole rounds, however many rows
+# a round turned out to have.
+#
+# The writer creates the readings table (and its daily partitions) if it
+# is missing and tops the partitions up once a day, so collectors work
+# against an empty database without the rollup job or readings_store.py.
+#
+# With a spool.Spool attached, rows go to the on-disk spool instead of
+# memory and the worker becomes a drain that replays the spool in bulk,
+# so a database outage delays rows instead of dropping them. After a
+# failed flush the worker backs off (flush_interval, doubling up to a
+# minute) before trying again, however many rows are waiting.
+
+import collections
+import logging
+import threading
+import time
+from datetime import date
+
+import mysql.connector
+import mysql.connector.pooling
+
+import readings_store
+
+# column order of every row handed to submit()
+COLUMNS = ("PID", "temperature", "humidity", "wind_speed", "soil_moisture", "timestamp")
+
+# longest wait between retries while the database is unreachable
+MAX_RETRY_DELAY = 60.0
+
+
+class BatchWriter:
+    def __init__(self, host, port, user, password, database='piSenseDB',
+                 batch_rows=50, flush_interval=5.0, pool_size=2, max_pending=10000, spool=None, logger=None,
+                 batch_rounds=None):
+        self.db_config = {
+            'host': host,
+            'port': port,
+            'user': user,
+            'password': password,
+            'database': database,
+            # the collectors stamp rows in UTC, so the column DEFAULT should be UTC too
+            'time_zone': '+00:00',
+        }
+        self.batch_rows = batch_rows
+        self.batch_rounds = batch_rounds
+        self.flush_interval = flush_interval
+        self.pool_size = pool_size
+        self.max_pending = max_pending
+        self.spool = spool
+        self.logger = logger or logging.getLogger("(db)")
+
+        self.pool = None
+        self.conn = None
+        # day the readings table was last checked, None until the first flush
+        self.prepared_on = None
+        self.pending = collections.deque()
+        # row count of every finished round still queued, oldest first, and rounds ended since the last flush
+        self.rounds = collections.deque()
+        self.rounds_due = 0
+        if batch_rounds is not None and spool is not None and len(spool):
+            # left over from a previous run, replayed as if it were one round
+            self.rounds.append(len(spool))
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        # seconds to hold off after a failed flush, doubles per failure up to MAX_RETRY_DELAY, 0 while healthy
+        self.retry_delay = 0.0
+
+        # throughput counters, read through stats()
+        self.started = time.monotonic()
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.commits = 0
+        self.commit_time = 0.0
+        self.last_commit_ms = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        # stop the worker and flush whatever is left
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def submit(self, table, row):
+        """
+        Queues one row (in COLUMNS order) for table. Never touches the network.
+        """
+        if self.spool is not None:
+            self.spool.append(table, row)
+            if self.batch_rounds is None and len(self.spool) >= self.batch_rows:
+                with self.cond:
+                    self.cond.notify()
+            return
+
+        with self.cond:
+            if len(self.pending) >= self.max_pending:
+                # database has been gone for a while, drop the oldest rows
+                self.pending.popleft()
+                if self.rounds:
+                    self.rounds[0] -= 1
+                    if not self.rounds[0]:
+                        self.rounds.popleft()
+                self.rows_dropped += 1
+                self.logger.warning(f"writer queue full ({self.max_pending} rows), dropping oldest row")
+            self.pending.append((table, tuple(row)))
+            if self.batch_rounds is None and len(self.pending) >= self.batch_rows:
+                self.cond.notify()
+
+    def end_round(self):
+        """
+        Marks everything submitted so far as one finished round. Only used
+        with batch_rounds, every batch_rounds-th call triggers a flush.
+        """
+        with self.cond:
+            rows = self._queued() - sum(self.rounds)
+            if rows > 0:
+                self.rounds.append(rows)
+            self.rounds_due += 1
+            if self.rounds_due >= self.batch_rounds:
+                self.cond.notify()
+
+    def _due(self):
+        if self.batch_rounds is not None:
+            return self.rounds_due >= self.batch_rounds
+        return self._queued() >= self.batch_rows
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.retry_delay:
+                    # the last flush failed, hold off however full the queue is so an outage
+                    # costs one connect attempt per retry_delay instead of a busy loop
+                    deadline = time.monotonic() + self.retry_delay
+                    while self.running and time.monotonic() < deadline:
+                        self.cond.wait(timeout=deadline - time.monotonic())
+                elif self.running and not self._due():
+                    self.cond.wait(timeout=self.flush_interval)
+                running = self.running
+                if not running and self._queued() > sum(self.rounds):
+                    # shutting down, whatever is left counts as finished
+                    self.rounds.append(self._queued() - sum(self.rounds))
+                self.rounds_due = 0
+                if self.spool is None:
+                    batch = self._take(len(self.pending) if self.batch_rounds is None else sum(self.rounds))
+
+            ok = False
+            try:
+                if self.spool is not None:
+                    ok = self._drain()
+                elif not batch or self.flush(batch):
+                    ok = True
+                else:
+                    self.rows_dropped += len(batch)
+                    self.logger.error(f"dropped {len(batch)} rows")
+            except Exception:
+                # a bad row or driver bug must not stop the worker, later rounds still get written
+                self.logger.exception("writer flush failed")
+                if self.spool is None:
+                    self.rows_dropped += len(batch)
+
+            if ok:
+                self.retry_delay = 0.0
+            else:
+                self.retry_delay = min(max(self.retry_delay * 2, self.flush_interval), MAX_RETRY_DELAY)
+                self.logger.info(f"retrying the database in {self.retry_delay:.0f}s")
+
+            if not running:
+                self._disconnect()
+                if self.spool is not None:
+                    self.spool.close()
+                return
+
+    def _queued(self):
+        return len(self.spool) if self.spool is not None else len(self.pending)
+
+    def _take(self, rows):
+        # the oldest rows off the in-memory queue, caller holds cond
+        self._finished(rows)
+        return [self.pending.popleft() for _ in range(rows)]
+
+    def _finished(self, rows):
+        # the oldest rows are on their way to the database, forget their round sizes
+        while rows and self.rounds:
+            n = min(rows, self.rounds[0])
+            rows -= n
+            self.rounds[0] -= n
+            if not self.rounds[0]:
+                self.rounds.popleft()
+
+    def _chunk(self, max_records):
+        # rows in the next spool batch: whole rounds up to max_records, only an oversized round is split
+        if self.batch_rounds is None:
+            return max_records
+        with self.cond:
+            rows = 0
+            for n in self.rounds:
+                if rows + n > max_records:
+                    break
+                rows += n
+            if not rows and self.rounds:
+                rows = min(self.rounds[0], max_records)
+            return rows
+
+    def _drain(self):
+        # replay the spool in bulk until it is empty or the database goes away,
+        # rows stay on disk until their batch has been committed. False if a flush failed
+        max_records = max(self.batch_rows, 500)
+        ok = True
+        while True:
+            rows = self._chunk(max_records)
+            batch, end = self.spool.pending(rows) if rows else ([], None)
+            if not batch:
+                break
+            if not self.flush(batch):
+                self.logger.warning(f"{len(self.spool)} rows held in spool until the database is back")
+                ok = False
+                break
+            self.spool.commit(end)
+            if self.batch_rounds is not None:
+                with self.cond:
+                    self._finished(len(batch))
+        self.spool.flush()
+        return ok
+
+    def stats(self):
+        """
+        Returns rows/s since start and commit latency counters.
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            'rows': self.rows_written,
+            'dropped': self.rows_dropped,
+            'spooled': len(self.spool) if self.spool is not None else 0,
+            'rows_per_s': self.rows_written / elapsed,
+            'commits': self.commits,
+            'avg_commit_ms': (self.commit_time / self.commits * 1000) if self.commits else 0.0,
+            'last_commit_ms': self.last_commit_ms,
+        }
+
+    def _connect(self):
+        # keep one connection checked out for the life of the worker,
+        # ping(reconnect) revives it after the server drops idle sessions
+        if self.conn is None:
+            if self.pool is None:
+                self.pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="piSenseDB_writer", pool_size=self.pool_size, **self.db_config)
+            self.conn = self.pool.get_connection()
+        else:
+            self.conn.ping(reconnect=True, attempts=1)
+        return self.conn
+
+    def _prepare(self, conn):
+        # DDL only runs when it is needed, and a failure (an INSERT-only account has no CREATE or
+        # ALTER privilege) is logged but never stops the insert from being attempted
+        today = date.today()
+        if self.prepared_on == today:
+            return
+        table = readings_store.READINGS_TABLE
+        with conn.cursor() as cursor:
+            if not readings_store.table_exists(cursor):
+                try:
+                    readings_store.create_table(cursor)
+                    self.logger.info(f"created {table}")
+                except mysql.connector.Error as e:
+                    self.logger.error(f"{table} is missing and could not be created: {e}")
+                    return
+            try:
+                readings_store.ensure_partitions(cursor)
+            except mysql.connector.Error as e:
+                # rows still land in pmax, try again tomorrow
+                self.logger.warning(f"could not add partitions to {table}: {e}")
+        conn.commit()
+        self.prepared_on = today
+
+    def _disconnect(self):
+        if self.conn is None:
+            return
+        try:
+            # pooled connections go back to the pool on close
+            self.conn.close()
+        except mysql.connector.Error as e:
+            self.logger.debug(f"connection could not be returned to pool: {e}")
+        self.conn = None
+
+    def flush(self, batch):
+        # group rows by destination table so each table costs one executemany
+        tables = {}
+        for table, row in batch:
+            tables.setdefault(table, []).append(row)
+
+        try:
+            conn = self._connect()
+            self._prepare(conn)
+            start = time.perf_counter()
+            with conn.cursor() as cursor:
+                for table, rows in tables.items():
+                    sql = (f"INSERT INTO {table} ({', '.join(COLUMNS)}) "
+                           f"VALUES ({', '.join(['%s'] * len(COLUMNS))})")
+                    cursor.executemany(sql, rows)
+            # one commit for every table in the batch
+            conn.commit()
+            elapsed = time.perf_counter() - start
+
+            self.rows_written += len(batch)
+            self.commits += 1
+            self.commit_time += elapsed
+            self.last_commit_ms = elapsed * 1000
+            self.logger.info(f"flushed {len(batch)} rows to {len(tables)} table(s) in {self.last_commit_ms:.1f} ms")
+            return True
+
+        except mysql.connector.Error as e:
+            self.logger.error(f"data base ERROR: {e}")
+            self._disconnect()
+            return False
@@ -0,0 +1,122 @@
+# Open-Meteo forecast with a local cache.
+#
+# The web app used to call Open-Meteo on every plot request with no
+# timeout. ForecastCache keeps the whole hourly series in memory, serves
+# it until it is refresh_interval old, and after that keeps serving the
+# stale copy while a background thread fetches a new one
+# (stale-while-revalidate). Only the very first fetch is synchronous, and
+# every fetch has a hard timeout.
+
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+flogger = logging.getLogger("(forecast)")
+
+# Open-Meteo variable name -> measure name used by the sensors
+HOURLY = {
+    'temperature_2m': 'temperature',
+    'relativehumidity_2m': 'humidity',
+    'wind_speed_10m': 'wind_speed',
+}
+
+
+class OpenMeteoSource:
+    url = "https://api.open-meteo.com/v1/forecast"
+
+    def __init__(self, latitude=36.97, longitude=-122.03):
+        self.params = {
+            'latitude': latitude,
+            'longitude': longitude,
+            'hourly': ','.join(HOURLY),
+        }
+
+    def fetch(self, timeout):
+        import requests
+
+        r = requests.get(self.url, params=self.params, timeout=timeout)
+        r.raise_for_status()
+        data = r.json()['hourly']
+        series = {'time': [datetime.fromisoformat(t) for t in data['time']]}
+        for name, measure in HOURLY.items():
+            series[measure] = data[name]
+        return series
+
+
+class StubSource:
+    """
+    Offline stand-in that generates a smooth 48 hour series, for running
+    the dashboard or tests without network access.
+    """
+    def fetch(self, timeout):
+        start = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=24)
+        hours = [start + timedelta(hours=h) for h in range(48)]
+        return {
+            'time': hours,
+            'temperature': [15 + 5 * math.sin(2 * math.pi * t.hour / 24) for t in hours],
+            'humidity': [60 - 15 * math.sin(2 * math.pi * t.hour / 24) for t in hours],
+            'wind_speed': [8.0 for _ in hours],
+        }
+
+
+class ForecastCache:
+    def __init__(self, source, refresh_interval=600, timeout=5):
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.data = None
+        self.fetched_at = 0.0
+        self.refreshing = False
+
+    def _refresh(self):
+        try:
+            data = self.source.fetch(self.timeout)
+        except Exception as e:
+            flogger.warning(f"forecast refresh failed, keeping previous copy: {e}")
+            data = None
+
+        with self.lock:
+            if data is not None:
+                self.data = data
+            # a failed fetch also waits out the interval instead of retrying every request
+            self.fetched_at = time.monotonic()
+            self.refreshing = False
+
+    def get(self):
+        """
+        Returns the hourly series dict (time plus one list per measure), or
+        None if no forecast has ever been fetched.
+        """
+        with self.lock:
+            age = time.monotonic() - self.fetched_at
+            if self.data is not None and age < self.refresh_interval:
+                return self.data
+            if self.refreshing:
+                return self.data
+            self.refreshing = True
+            first = self.data is None and self.fetched_at == 0.0
+
+        if first:
+            # nothing to serve yet, fetch inline (bounded by the timeout)
+            self._refresh()
+        else:
+            threading.Thread(target=self._refresh, name="forecast-refresh", daemon=True).start()
+
+        with self.lock:
+            return self.data
+
+    def current(self, when=None):
+        """
+        Forecast values for the hour closest to when (UTC now by default).
+        """
+        data = self.get()
+        if not data or not data['time']:
+            return {}
+
+        when = when or datetime.utcnow()
+        i = min(range(len(data['time'])), key=lambda k: abs(data['time'][k] - when))
+        return {measure: data[measure][i] for measure in HOURLY.values()}
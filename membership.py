@@ -0,0 +1,95 @@
+# Ring membership for the token ring.
+#
+# Nodes are ordered by id and the ring wraps from the highest id back to
+# the lowest. The live successor and predecessor are cached and only
+# recomputed when a node fails or comes back, so the per-hop lookup is
+# O(1) however many stations are in the ring.
+#
+# Config file (JSON):
+#   {"nodes": [{"id": 1, "host": "192.168.0.10", "port": 9001},
+#              {"id": 2, "host": "192.168.0.11", "port": 9002}, ...]}
+
+import collections
+import json
+
+Node = collections.namedtuple("Node", ["id", "host", "port"])
+
+
+class Membership:
+    def __init__(self, nodes, my_id):
+        self.nodes = sorted(nodes, key=lambda n: n.id)
+        self.index = {n.id: i for i, n in enumerate(self.nodes)}
+        if len(self.index) != len(self.nodes):
+            raise RuntimeError("ring config has duplicate node ids")
+        if my_id not in self.index:
+            raise RuntimeError(f"P{my_id} is not in the ring config")
+
+        self.my_id = my_id
+        self.me = self.nodes[self.index[my_id]]
+        self.failed = set()
+        self._relink()
+
+    @classmethod
+    def load(cls, path, my_id):
+        with open(path) as f:
+            config = json.load(f)
+        nodes = [Node(int(n["id"]), n.get("host", "127.0.0.1"), int(n["port"])) for n in config["nodes"]]
+        return cls(nodes, my_id)
+
+    @classmethod
+    def from_neighbours(cls, my_id, my_host, my_port, next_host, next_port, prev_host, prev_port):
+        # the original 3-node layout from --next-*/--prev-* args
+        next_id = (my_id % 3) + 1
+        prev_id = ((my_id + 1) % 3) + 1
+        return cls([Node(my_id, my_host, my_port),
+                    Node(next_id, next_host, next_port),
+                    Node(prev_id, prev_host, prev_port)], my_id)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def position(self):
+        # my place in ring order, 0 for the lowest id
+        return self.index[self.my_id]
+
+    def _walk(self, step):
+        # nearest live node in direction step, skipping any run of failed nodes
+        i = self.index[self.my_id]
+        for _ in range(len(self.nodes) - 1):
+            i = (i + step) % len(self.nodes)
+            if self.nodes[i].id not in self.failed:
+                return self.nodes[i]
+        return self.me
+
+    def _relink(self):
+        self.next = self._walk(1)
+        self.prev = self._walk(-1)
+
+    def successor(self):
+        return self.next
+
+    def predecessor(self):
+        return self.prev
+
+    def alone(self):
+        return self.next.id == self.my_id
+
+    def is_incrementer(self):
+        # the last live node before the ring wraps closes the round
+        return self.next.id <= self.my_id
+
+    def is_starter(self):
+        return self.position() == 0
+
+    def live_ids(self):
+        return [n.id for n in self.nodes if n.id not in self.failed]
+
+    def mark_failed(self, node_id):
+        if node_id != self.my_id and node_id in self.index and node_id not in self.failed:
+            self.failed.add(node_id)
+            self._relink()
+
+    def mark_alive(self, node_id):
+        if node_id in self.failed:
+            self.failed.discard(node_id)
+            self._relink()
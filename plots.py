@@ -0,0 +1,129 @@
+# Figure rendering shared by the web app and the token ring.
+#
+# Everything here is called through plain module-level functions taking
+# picklable arguments and returning PNG bytes (or writing a file), so the
+# calls can run in render_pool worker processes instead of the request
+# thread or the token hot path. The token plot keeps one figure alive per
+# worker and only swaps its data between rounds.
+
+import io
+import os
+
+import matplotlib
+# prevents Mac OS GUI pop-up error
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+# ***alter this line for sampling duration
+RESAMPLE = '15s'
+
+
+def render_plot(df, measure, forecast, rule=RESAMPLE):
+    # df has the series cache COLUMNS with time already datetime64
+    pivot = df.pivot_table(index='time', columns='PID', values=measure).resample(rule).mean()
+    return render_pivot(pivot, measure, forecast)
+
+
+def render_downsampled(rows, measure, forecast):
+    # rows are (PID, bucket, mean, min, max) already aggregated by SQL
+    df = pd.DataFrame(rows, columns=['PID', 'time', 'mean', 'min', 'max'])
+    df['time'] = pd.to_datetime(df['time'])
+    pivot = df.pivot_table(index='time', columns='PID', values='mean')
+    return render_pivot(pivot, measure, forecast)
+
+
+def render_pivot(pivot, measure, forecast):
+    avg = pivot.mean(axis=1)
+
+    fig, ax = plt.subplots()
+    for col in pivot.columns:
+        ax.plot(pivot.index, pivot[col], alpha=0.3, label=f'Pi {col}')
+    ax.plot(avg.index, avg, linewidth=2, label='Average')
+    if forecast is not None:
+        ax.axhline(forecast, linestyle='--', color='red', label='Forecast')
+    # ax.set_title(measure.replace('_', ' ').title())
+    ax.legend()
+    ax.set_xlabel("Time")
+    ax.set_ylabel(measure.title())
+    fig.autofmt_xdate(rotation=90)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+class TokenFigure:
+    """
+    The 2x2 round plot kept alive between rounds. Each panel has one
+    scatter whose offsets and colours are swapped in place, so a round
+    only pays for the redraw and encode, not for building a figure.
+    """
+    keys = ["SHT30 Temp", "SHT30 Hum", "SEESAW Hum", "WIND Speed"]
+    titles = ["Temp (C)", "Humidity (%)", "Soil Moisture", "Wind Speed"]
+    colors = ['blue', 'red', 'green']
+    avg_color = 'black'
+
+    def __init__(self):
+        self.fig, ax = plt.subplots(2, 2)
+        self.axes = [ax[0][0], ax[0][1], ax[1][0], ax[1][1]]
+        self.scatters = []
+        for axis, title in zip(self.axes, self.titles):
+            axis.set_title(title)
+            self.scatters.append(axis.scatter([], []))
+        self.labels = None
+
+    def update(self, data):
+        #should be P1, P2, P3, AVG
+        labels = list(data.keys()) + ["AVG"]
+        x_position = np.arange(len(labels))
+        if labels != self.labels:
+            # ring membership changed, redo ticks and layout once
+            colors = [self.colors[j % len(self.colors)] for j in range(len(data))] + [self.avg_color]
+            for axis, scatter in zip(self.axes, self.scatters):
+                axis.set_xticks(x_position, labels)
+                axis.set_xlim(-0.5, len(labels) - 0.5)
+                scatter.set_facecolors(colors)
+                scatter.set_edgecolors(colors)
+            self.fig.tight_layout()
+            self.labels = labels
+
+        for axis, scatter, key in zip(self.axes, self.scatters, self.keys):
+            #will extract sensor data. data looks like => {'P1': {'SHT30': 24.3C}, ...}
+            values = np.array([data[pi][key] for pi in data], dtype=float)
+            values = np.append(values, values.mean())
+            scatter.set_offsets(np.column_stack((x_position, values)))
+            # scatters don't take part in autoscaling, pad the limits by hand
+            lo, hi = np.nanmin(values), np.nanmax(values)
+            pad = max((hi - lo) * 0.1, 0.5)
+            axis.set_ylim(lo - pad, hi + pad)
+
+    def render(self, filename=None):
+        # PNG bytes, or written to filename via a temp file so readers never see a partial image
+        if filename is None:
+            buf = io.BytesIO()
+            self.fig.savefig(buf, format='png')
+            return buf.getvalue()
+        tmp = f"{filename}.tmp"
+        self.fig.savefig(tmp, format='png')
+        os.replace(tmp, filename)
+        return filename
+
+
+# one persistent figure per render worker process
+_token_figure = None
+
+
+def render_token(data, filename=None):
+    """
+    Scatter of every Pi's readings plus their average for one round.
+    data is the P<n> entries of a token, {'P1': {'SHT30 Temp': ..., ...}, ...}.
+    Writes filename and returns it, or returns the PNG bytes if filename is None.
+    """
+    global _token_figure
+    if _token_figure is None:
+        _token_figure = TokenFigure()
+    _token_figure.update(data)
+    return _token_figure.render(filename)
@@ -1,39 +1,64 @@
 # Library imports
+import asyncio
 import socket
 import sys
+import threading
 import matplotlib.pyplot as plt
 import numpy as np
 import argparse
 import time
-from datetime import datetime
 import json
-import mysql.connector
+import sensors
+import wire
+from db_writer import BatchWriter
+from spool import Spool
+from readings_store import READINGS_TABLE
+from scheduler import RoundScheduler
 
 #Change to false when using real sensors
 TESTING = False
 
-if not TESTING:
-    import board
-    import busio
-    import simpleio
-    import adafruit_ads1x15.ads1015 as ADS
-    from adafruit_ads1x15.analog_in import AnalogIn
-    from adafruit_seesaw.seesaw import Seesaw
-    import adafruit_sht31d
-else:
-    import random
+
+def parse_peer(value: str):
+    # Parses an "ip:port" peer entry
+    ip, sep, port = value.rpartition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"{value}: expected ip:port")
+
+    try:
+        socket.inet_aton(ip)
+    except OSError:
+        raise argparse.ArgumentTypeError(f"{value}: Enter a valid IPv4 Address")
+
+    try:
+        port = int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value}: Enter a valid port number")
+
+    if (port < 1024 or port > 65535):
+        raise argparse.ArgumentTypeError(f"{value}: Enter a valid port in the range 1024-65535")
+
+    return ip, port
 
 def parse_args():
     parser = argparse.ArgumentParser(
         prog="Primary",
-        description="Primary is a peer in an Adhoc network that contacts two other peers for sensor data.",
-        epilog="Example usage:\n python primary.py --sec1_ip X.X.X.X --sec1_port N --sec2_ip Y.Y.Y.Y --sec2_port M --db_ip Z.Z.Z.Z --db_port V"
+        description="Primary is a peer in an Adhoc network that contacts other peers for sensor data.",
+        epilog="Example usage:\n python primary.py --peer X.X.X.X:N --peer Y.Y.Y.Y:M --db_ip Z.Z.Z.Z --db_port V"
     )
 
+    parser.add_argument("--peer", action="append", default=[], type=parse_peer, help="Enter ip:port for a secondary peer. Repeat for every peer.", required=False)
     parser.add_argument("--sec1_ip", default="127.0.0.1", type=str, help="Enter IPv4 Address for peer 1 (Sec1).", required=False)
-    parser.add_argument("--sec1_port", type=int, help="Enter port number for peer 1 (Sec1).", required=True)
+    parser.add_argument("--sec1_port", type=int, help="Enter port number for peer 1 (Sec1).", required=False)
     parser.add_argument("--sec2_ip", default="127.0.0.1", type=str, help="Enter IPv4 Address for peer 2 (Sec2).", required=False)
-    parser.add_argument("--sec2_port", type=int, help="Enter port number for peer 2 (Sec2).", required=True)
+    parser.add_argument("--sec2_port", type=int, help="Enter port number for peer 2 (Sec2).", required=False)
+    parser.add_argument("--round_hz", default=0.2, type=float, help="Target polling rounds per second.", required=False)
+    parser.add_argument("--round_timeout", default=5, type=float, help="Deadline in seconds for polling all peers in a round.", required=False)
+    parser.add_argument("--db_batch_rounds", default=1, type=int, help="Number of rounds to commit to the database in one transaction.", required=False)
+    parser.add_argument("--spool_path", default="primary.spool", type=str, help="File readings are spooled to before upload. Empty to disable.", required=False)
+    parser.add_argument("--listen", default=None, type=int, help="Port to accept pushed readings on (Secondary --push). Off by default.", required=False)
+    parser.add_argument("--listen_ip", default="0.0.0.0", type=str, help="IPv4 Address the push collector binds to.", required=False)
+    parser.add_argument("--station_id", default=None, type=int, help="PID the Primary's own readings are stored under. Defaults to one past the last peer.", required=False)
     parser.add_argument("--db_ip", default="127.0.0.1", type=str, help="Enter IPv4 Address for database.", required=False)
     parser.add_argument("--db_port", default=3306, type=int, help="Enter port number for database.", required=False)
     parser.add_argument("--db_user", default="root", type=str, help="Enter user for database.", required=False)
@@ -41,17 +66,43 @@ def parse_args():
 
     args = parser.parse_args()
 
-    try:
-        socket.inet_aton(args.sec1_ip)
-    except OSError:
-        print("--sec1_ip: Enter a valid IPv4 Address")
-        raise
-
-    try:
-        socket.inet_aton(args.sec2_ip)
-    except OSError:
-        print("--sec2_ip: Enter a valid IPv4 Address")
-        raise
+    # Legacy --secN flags are folded into the peer list
+    peers = []
+    for name, ip, port in (("sec1", args.sec1_ip, args.sec1_port), ("sec2", args.sec2_ip, args.sec2_port)):
+        if port is None:
+            continue
+        try:
+            peers.append(parse_peer(f"{ip}:{port}"))
+        except argparse.ArgumentTypeError as e:
+            print(f"--{name}: {e}")
+            raise RuntimeError(f"--{name}: {e}")
+    peers += args.peer
+
+    if not peers and args.listen is None:
+        raise RuntimeError("Enter at least one --peer ip:port or a --listen port")
+
+    listen = None
+    if args.listen is not None:
+        try:
+            socket.inet_aton(args.listen_ip)
+        except OSError:
+            raise RuntimeError("--listen_ip: Enter a valid IPv4 Address")
+        if (args.listen < 1024 or args.listen > 65535):
+            raise RuntimeError("--listen: Enter a valid port in the range 1024-65535")
+        listen = (args.listen_ip, args.listen)
+
+    if args.db_batch_rounds < 1:
+        raise RuntimeError("--db_batch_rounds: Enter a positive number of rounds")
+
+    # Polled peers are stored as PIDs 1..N, the Primary's own readings need an id of their own
+    if args.station_id is not None and 1 <= args.station_id <= len(peers):
+        raise RuntimeError(f"--station_id: {args.station_id} is already the PID of polled peer Sec{args.station_id}")
+
+    if args.round_hz <= 0:
+        raise RuntimeError("--round_hz: Enter a positive rate")
+
+    if args.round_timeout <= 0:
+        raise RuntimeError("--round_timeout: Enter a positive number of seconds")
 
     try:
         socket.inet_aton(args.db_ip)
@@ -59,85 +110,66 @@ def parse_args():
         print("--db_ip: Enter a valid IPv4 Address")
         raise
 
-    if (args.sec1_port < 1024 or args.sec1_port > 65535):
-        raise RuntimeError("--sec1_port: Enter a valid port in the range 1024-65535")
-
-    if (args.sec2_port < 1024 or args.sec2_port > 65535):
-        raise RuntimeError("--sec2_port: Enter a valid port in the range 1024-65535")
-
     if (args.db_port < 1024 or args.db_port > 65535):
         raise RuntimeError("--db_port: Enter a valid port in the range 1024-65535")
 
 
-    return args.sec1_ip, args.sec1_port, args.sec2_ip, args.sec2_port, args.db_ip, args.db_port, args.db_user, args.db_pass
+    return peers, args.round_hz, args.round_timeout, args.db_batch_rounds, args.spool_path, listen, args.db_ip, args.db_port, args.db_user, args.db_pass, args.station_id
 
 
 class Primary():
-    def __init__(self, sec1_ip: int, sec1_port: int, sec2_ip: int, sec2_port: int, db_ip: int, db_port: int, db_user: str, db_pass: str):
-        self.sec1_ip = sec1_ip
-        self.sec1_port = sec1_port
-        self.sec2_ip = sec2_ip
-        self.sec2_port = sec2_port
+    def __init__(self, peers: list, db_ip: int, db_port: int, db_user: str, db_pass: str, round_hz: float = 0.2, round_timeout: float = 5, batch_rounds: int = 1, spool_path: str = "primary.spool", listen: tuple = None, station_id: int = None):
+        # List of (ip, port) tuples, Sec1..SecN
+        self.peers = peers
         self.db_ip = db_ip
         self.db_port = db_port
         self.db_user = db_user
         self.db_pass = db_pass
 
-        self.timeout = 5
+        self.timeout = round_timeout
+        self.scheduler = RoundScheduler(round_hz)
+        self.interval = self.scheduler.period
         self.invalid = np.nan
-
-        self.p1 = []
-        self.p2 = []
-        self.p3 = []
+        self.sensor = sensors.get_driver(simulated=TESTING)
+
+        # One slot per peer (p1..pN) followed by the Primary's own readings,
+        # each a list of rows since a peer can hand over several buffered samples per round
+        self.readings = [[] for _ in range(len(self.peers) + 1)]
+
+        # PID of each slot: polled peers are 1..N, the Primary's own readings default to N+1.
+        # Pushed readings may not reuse any of them or two stations would share one series
+        self.station_id = len(self.peers) + 1 if station_id is None else station_id
+        self.pids = list(range(1, len(self.peers) + 1)) + [self.station_id]
+        if len(set(self.pids)) != len(self.pids):
+            raise ValueError(f"station_id {self.station_id} is already the PID of a polled peer")
+
+        # Long-lived (reader, writer) session per peer on one event loop that outlives the rounds,
+        # and the epoch of the newest sample taken from each peer for the next since= request
+        self.loop = asyncio.new_event_loop()
+        self.sessions = {}
+        self.last_epoch = [None] * len(self.peers)
+
+        # Optional (ip, port) collector pushing secondaries stream readings into, on its own loop and thread
+        self.listen = listen
+        self.pushed = 0
+        self.push_streams = 0
+        self.rejected_pushes = 0
+        self.collector_error = None
+
+        # Readings land in the on-disk spool first so a database outage never drops a round
+        self.spool = Spool(spool_path) if spool_path else None
+
+        # One long-lived connection, flushed every batch_rounds rounds in a single transaction
+        self.writer = BatchWriter(host=db_ip, port=db_port, user=db_user, password=db_pass,
+                                  batch_rounds=batch_rounds,
+                                  flush_interval=batch_rounds * self.interval, pool_size=1,
+                                  spool=self.spool)
 
     def genData(self):
+        # Sensor handles are cached by the shared driver, TESTING selects the simulated backend
+        return sensors.read_measures(self.sensor)
 
-        if not TESTING:
-            # create the I2C bus
-            i2c = busio.I2C(board.SCL, board.SDA)
-
-            # create the ADS object
-            ads = ADS.ADS1015(i2c)
-
-            # create the analog input channel for the anemometer on ADC pin(2)
-            chan = AnalogIn(ads, ADS.P2)
-
-            # create the Seesaw object for the soil moisture sensor
-            soil_sensor = Seesaw(i2c, addr=0x36)
-
-            # create the SHT31D object for the temperature and humidity sensor
-            temp_sensor = adafruit_sht31d.SHT31D(i2c)
-
-            # maps the voltage to wind speed via simpleio
-            voltage = chan.voltage
-            if voltage < 0.41:
-                wind_speed = 0
-            else:
-                wind_speed = simpleio.map_range(voltage, 0.4, 2, 0, 32.4)
-
-            SHT30_temp = temp_sensor.temperature
-            SHT30_hum = temp_sensor.relative_humidity
-            soil_moist = soil_sensor.moisture_read()
-
-            data = {
-                'temperature': SHT30_temp,
-                'humidity': SHT30_hum,
-                'wind_speed': wind_speed,
-                'soil_moisture': soil_moist,
-                # 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-            }
-        else:
-            data = {
-                'temperature': random.randrange(0, 20),
-                'humidity': random.randrange(0, 20),
-                'wind_speed': random.randrange(0, 20),
-                'soil_moisture': random.randrange(0, 20),
-                # 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-
-        return data
-
-    def parse_data(self, data: dict, peer: str):
+    def parse_data(self, data: dict):
             temp = []
 
             # Parse data into temporary list
@@ -153,100 +185,176 @@ class Primary():
                 if key == 'timestamp':
                     temp.append(value)
 
-            # Assign to correct peer
-            if peer == 'Sec1':
-                self.p1 = temp
-            if peer == 'Sec2':
-                self.p2 = temp
-            if peer == 'Primary':
-                self.p3 = temp
+            return temp
 
     def local(self):
         localData = self.genData()
-        self.parse_data(localData, 'Primary')
-
+        # The last slot belongs to the Primary
+        self.readings[len(self.peers)] = [self.parse_data(localData)]
+
+    async def session(self, peer: int):
+        # Reuse the open connection to Sec{peer+1}, or open one if the last round dropped it
+        if peer not in self.sessions:
+            ip, port = self.peers[peer]
+            self.sessions[peer] = await asyncio.open_connection(ip, port)
+        return self.sessions[peer]
+
+    def close_session(self, peer: int):
+        session = self.sessions.pop(peer, None)
+        if session is not None:
+            session[1].close()
+
+    async def poll_peer(self, peer: int):
+        # Pull every sample Sec{peer+1} buffered since the last one we took, over the standing session
+        reader, writer = await self.session(peer)
+
+        try:
+            # First round asks for one round's worth, after that nothing is missed even across reconnects
+            since = self.last_epoch[peer] or time.time() - self.interval
+            print(f"Requesting data since {since:.3f} from Sec{peer+1}")
+            request = f'Requesting data since={since!r}\n'.encode()
+            writer.write(wire.encode(request))
+            await writer.drain()
+
+            # Reply is one length-prefixed frame, however it was split on the wire
+            samples = json.loads(await wire.read_frame(reader))
+        except BaseException:
+            # Timed out or failed mid-frame, the stream can't be trusted, reconnect next round
+            self.close_session(peer)
+            raise
+
+        self.readings[peer] = [self.parse_data(sample) for sample in samples]
+        if samples:
+            self.last_epoch[peer] = samples[-1]['epoch']
+
+    async def poll_all(self):
+        # Fan out to every peer at once so a round costs the slowest peer, not the sum
+        tasks = {asyncio.ensure_future(self.poll_peer(peer)): peer for peer in range(len(self.peers))}
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+
+        for task in pending:
+            task.cancel()
+            peer = tasks[task]
+            print(f"Communication failed w/ Sec{peer+1}: timed out after {self.timeout}s.")
+            self.readings[peer] = []
+
+        for task in done:
+            peer = tasks[task]
+            if task.exception() is not None:
+                print(f"Communication failed w/ Sec{peer+1}: {task.exception()}.")
+                self.readings[peer] = []
+
+        if pending:
+            await asyncio.wait(pending)
 
     def network(self):
-        # Make two calls into the Network
-        # Request to Host1
-        # Request to Host2
-
-        # Host1
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(self.timeout)
-
-            try:
-                s.connect((self.sec1_ip, self.sec1_port))
-
-                print("Requesting data from Sec1")
-                request = b'Requesting data\n'
-                s.sendall(request)
-
-                response = json.loads(s.recv(1024).decode())
-                self.parse_data(response, 'Sec1')
-
-            except Exception as e:
-                print(f"Communication failed w/ Sec1: {e}.")
-                self.p1 = []
-
-        # Host2
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(self.timeout)
-
-            try:
-                s.connect((self.sec2_ip, self.sec2_port))
-
-                print("Requesting data from Sec2")
-                request = b'Requesting data\n'
-                s.sendall(request)
-
-                response = json.loads(s.recv(1024).decode())
-                self.parse_data(response, 'Sec2')
-
-            except Exception as e:
-                print(f"Communication failed w/ Sec2: {e}.")
-                self.p2 = []
+        # Poll every secondary concurrently under a single round deadline, sessions stay open between rounds
+        if self.peers:
+            self.loop.run_until_complete(self.poll_all())
+
+    async def handle_push(self, reader, writer):
+        # One pushing secondary, every frame is a reading dict with its station id, written as it lands
+        addr = writer.get_extra_info('peername')
+        self.push_streams += 1
+        print(f"Push stream opened from {addr}")
+        try:
+            while True:
+                try:
+                    sample = json.loads(await wire.read_frame(reader))
+                except asyncio.IncompleteReadError:
+                    break
+                station = int(sample['station'])
+                if station in self.pids:
+                    # Refused without an ACK, the secondary keeps its samples and its log shows the failures
+                    print(f"Push stream from {addr} rejected: station {station} is already a polled or local PID, "
+                          f"restart that secondary with another --station_id")
+                    self.rejected_pushes += 1
+                    break
+                data = [station] + self.parse_data(sample)
+                self.writer.submit(READINGS_TABLE, data)
+                self.pushed += 1
+                # Queued (or spooled), the secondary can move its resend point past this sample
+                writer.write(wire.ACK)
+                await writer.drain()
+        except (wire.FrameError, ValueError, KeyError, TypeError, OSError) as e:
+            print(f"Push stream from {addr} failed: {e}")
+        finally:
+            self.push_streams -= 1
+            print(f"Push stream from {addr} closed")
+            writer.close()
+
+    async def collect(self, ready):
+        server = await asyncio.start_server(self.handle_push, *self.listen)
+        print(f"Accepting pushed readings on {self.listen[0]}:{self.listen[1]}")
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def serve_collector(self, ready):
+        try:
+            asyncio.run(self.collect(ready))
+        except BaseException as e:
+            # Hand the failure to start_collector instead of letting it die with the thread
+            self.collector_error = e
+            ready.set()
+
+    def start_collector(self):
+        # Pushed streams are served concurrently on a separate loop so polling rounds never hold them up
+        ready = threading.Event()
+        thread = threading.Thread(target=self.serve_collector, args=(ready,), name="collector", daemon=True)
+        thread.start()
+        if not ready.wait(timeout=5):
+            raise RuntimeError(f"Push collector on {self.listen[0]}:{self.listen[1]} did not start within 5s")
+        if self.collector_error is not None:
+            raise RuntimeError(f"Push collector could not listen on {self.listen[0]}:{self.listen[1]}: "
+                               f"{self.collector_error}") from self.collector_error
 
     def upload(self):
-        print("Attempting connection to piSenseDB")
-
-        with mysql.connector.connect(host=self.db_ip, port=self.db_port, database='piSenseDB', user=self.db_user, password=self.db_pass) as conn:
-            if conn.is_connected():
-                print("Successful connection to piSenseDB")
-
-                cursor = conn.cursor()
-
-                for peer in range(3):
-                    query = (f"INSERT INTO sensor_readings{peer+1} (PID, temperature, humidity, wind_speed, soil_moisture) " "VALUES(%s, %s, %s, %s, %s)")
-
-                    data = []
-                    if peer == 0: data = self.p1
-                    elif peer == 1: data = self.p2
-                    elif peer == 2: data = self.p3
-                    if (len(data)):
-                        data = [peer+1] + data
-                    
-                    if (data != []):
-                        cursor.execute(query, data)
-                        conn.commit()
-                        print(f"Commiting data: {data} into sensor_readings{peer+1} table")
+        # Queue every peer's row for this round, the writer commits them in one transaction
+        for peer in range(len(self.readings)):
+            rows = self.readings[peer]
+
+            for data in rows:
+                if (data != []):
+                    data = [self.pids[peer]] + data
+                    self.writer.submit(READINGS_TABLE, data)
+            if rows:
+                print(f"Queued {len(rows)} row(s) from PID {self.pids[peer]}, newest {rows[-1]} for {READINGS_TABLE} table")
+        # Whatever this round produced is committed together, however many peers answered
+        self.writer.end_round()
+
+        stats = self.writer.stats()
+        if self.listen is not None:
+            print(f"Push: {self.pushed} readings from {self.push_streams} open stream(s), {self.rejected_pushes} rejected for a taken station id")
+        print(f"DB: {stats['rows']} rows, {stats['rows_per_s']:.2f} rows/s, "
+              f"commit {stats['last_commit_ms']:.1f} ms (avg {stats['avg_commit_ms']:.1f} ms), {stats['spooled']} spooled, {stats['dropped']} dropped")
 
 
     def run(self):
         round_number = 1
-
-        while True:
-            print(f"Round {round_number}")
-            self.network()
-            self.local()
-            self.upload()
-            round_number += 1
-            time.sleep(5)
+        self.writer.start()
+
+        try:
+            if self.listen is not None:
+                self.start_collector()
+            while True:
+                # Rounds start on deadlines, so time spent polling comes out of the wait
+                self.scheduler.wait()
+                print(f"Round {round_number} ({self.scheduler.report()})")
+                self.network()
+                self.local()
+                self.upload()
+                round_number += 1
+        finally:
+            for peer in list(self.sessions):
+                self.close_session(peer)
+            self.loop.close()
+            self.writer.close()
 
 if __name__ == "__main__":
-    host1, port1, host2, port2, db_ip, db_port, db_user, db_pass = parse_args()
+    peers, round_hz, round_timeout, batch_rounds, spool_path, listen, db_ip, db_port, db_user, db_pass, station_id = parse_args()
 
-    primary = Primary(host1, port1, host2, port2, db_ip, db_port, db_user, db_pass)
+    primary = Primary(peers, db_ip, db_port, db_user, db_pass, round_hz, round_timeout, batch_rounds, spool_path, listen, station_id)
     primary.run()
 
 
@@ -0,0 +1,161 @@
+# Unified readings store.
+#
+# Every station writes to one sensor_readings table keyed by PID instead
+# of its own sensor_readingsN table. The table is indexed on
+# (PID, timestamp) and partitioned by day, so any set of stations over
+# any range is one indexed, partition-pruned query, and adding station N
+# needs no new table or code.
+#
+#   python readings_store.py --db_ip X.X.X.X create      create table and upcoming partitions
+#   python readings_store.py --db_ip X.X.X.X migrate     copy sensor_readingsN rows across (resumable)
+#   python readings_store.py --db_ip X.X.X.X partitions  add partitions for the coming days
+#
+# The collectors' BatchWriter also creates the table and keeps the
+# partitions topped up itself, so the commands are only needed up front.
+
+import argparse
+import logging
+from datetime import date, timedelta
+
+import mysql.connector
+
+slogger = logging.getLogger("(store)")
+
+READINGS_TABLE = "sensor_readings"
+LEGACY_PATTERN = r"^sensor_readings[0-9]+$"
+
+# ids re-checked behind the newest one a reader has seen, covers rows committed out of id order
+ID_LOOKBACK = 1000
+
+
+def partition_name(day):
+    return f"p{day:%Y%m%d}"
+
+
+def partition_clause(day):
+    # partition holding everything before the day after `day`
+    return f"PARTITION {partition_name(day)} VALUES LESS THAN (TO_DAYS('{day + timedelta(days=1)}'))"
+
+
+def table_exists(cursor, table=READINGS_TABLE):
+    # a plain lookup, unlike CREATE TABLE IF NOT EXISTS it needs no CREATE privilege
+    cursor.execute("""
+        SELECT 1 FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, (table,))
+    return cursor.fetchone() is not None
+
+
+def create_table(cursor, days_ahead=7):
+    today = date.today()
+    days = ",\n".join(partition_clause(today + timedelta(days=d)) for d in range(days_ahead + 1))
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {READINGS_TABLE} (
+            id BIGINT NOT NULL AUTO_INCREMENT,
+            PID INT NOT NULL,
+            temperature FLOAT,
+            humidity FLOAT,
+            wind_speed FLOAT,
+            soil_moisture FLOAT,
+            timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp),
+            KEY pid_ts (PID, timestamp),
+            KEY ts (timestamp)
+        )
+        PARTITION BY RANGE (TO_DAYS(timestamp)) (
+            PARTITION p_old VALUES LESS THAN (TO_DAYS('{today}')),
+            {days},
+            PARTITION pmax VALUES LESS THAN MAXVALUE
+        )
+    """)
+
+
+def ensure_partitions(cursor, days_ahead=7):
+    """
+    Splits pmax so there is a partition for every day up to days_ahead.
+    Rows for days without one still land in pmax, this just keeps pruning tight.
+    """
+    cursor.execute("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, (READINGS_TABLE,))
+    existing = {row[0] for row in cursor.fetchall()}
+    if "pmax" not in existing:
+        # missing or not partitioned by this module, nothing to split
+        return 0
+
+    today = date.today()
+    missing = [today + timedelta(days=d) for d in range(days_ahead + 1)
+               if partition_name(today + timedelta(days=d)) not in existing]
+    # only days after the newest existing partition can be carved out of pmax
+    newest = max((name for name in existing if name and name[1:].isdigit()), default=None)
+    missing = [day for day in missing if newest is None or partition_name(day) > newest]
+    if not missing:
+        return 0
+
+    parts = ",\n".join(partition_clause(day) for day in missing)
+    cursor.execute(f"""
+        ALTER TABLE {READINGS_TABLE} REORGANIZE PARTITION pmax INTO (
+            {parts},
+            PARTITION pmax VALUES LESS THAN MAXVALUE
+        )
+    """)
+    slogger.info(f"added {len(missing)} daily partition(s) to {READINGS_TABLE}")
+    return len(missing)
+
+
+def legacy_tables(cursor):
+    cursor.execute("""
+        SELECT TABLE_NAME FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME REGEXP %s
+        ORDER BY TABLE_NAME
+    """, (LEGACY_PATTERN,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def migrate(cursor, tables=None):
+    """
+    Copies rows from the per-Pi sensor_readingsN tables into the unified
+    table. A row is skipped if the unified table already has a row for the
+    same PID and timestamp (looked up on pid_ts), so an interrupted
+    migration can simply be rerun, and history older than what the
+    collectors have written since the switch is still copied.
+    """
+    total = 0
+    for table in tables or legacy_tables(cursor):
+        cursor.execute(f"""
+            INSERT INTO {READINGS_TABLE} (PID, temperature, humidity, wind_speed, soil_moisture, timestamp)
+            SELECT l.PID, l.temperature, l.humidity, l.wind_speed, l.soil_moisture, l.timestamp
+            FROM {table} l
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {READINGS_TABLE} u WHERE u.PID = l.PID AND u.timestamp = l.timestamp)
+        """)
+        slogger.info(f"migrated {cursor.rowcount} rows from {table}")
+        total += cursor.rowcount
+    return total
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        prog="readings_store",
+        description="Creates, migrates and maintains the unified sensor_readings table.",
+        epilog="Example usage:\n python readings_store.py --db_ip X.X.X.X migrate"
+    )
+    parser.add_argument("command", choices=("create", "migrate", "partitions"))
+    parser.add_argument("--db_ip", default="127.0.0.1", type=str, help="Enter IPv4 Address for database.")
+    parser.add_argument("--db_port", default=3306, type=int, help="Enter port number for database.")
+    parser.add_argument("--db_user", default="root", type=str, help="Enter user for database.")
+    parser.add_argument("--db_pass", default="", type=str, help="Enter password for user of database.")
+    parser.add_argument("--days_ahead", default=7, type=int, help="Number of future daily partitions to keep ready.")
+    args = parser.parse_args()
+
+    with mysql.connector.connect(host=args.db_ip, port=args.db_port, user=args.db_user,
+                                 password=args.db_pass, database='piSenseDB') as conn:
+        with conn.cursor() as cursor:
+            create_table(cursor, args.days_ahead)
+            if args.command == "migrate":
+                migrate(cursor)
+            ensure_partitions(cursor, args.days_ahead)
+        conn.commit()
@@ -0,0 +1,103 @@
+# Process pool for matplotlib rendering.
+#
+# Rendering is CPU bound and holds the GIL, so doing it in a Flask request
+# thread serialises every dashboard client and doing it on a ring node
+# delays the token. RenderPool runs the plots.py functions in worker
+# processes, one per core by default, and bounds how many jobs can be
+# queued or running. When it is full submit() raises RenderBusy straight
+# away instead of queueing, so callers can shed load (503, stale image,
+# skip a round's plot) and never block on rendering.
+#
+# Workers come from a forkserver with plots.py (matplotlib, pandas)
+# preloaded, never from the caller itself, so neither the first start nor a
+# restart after a worker dies forks a process that is already running
+# threads (DB writer, rollups, forecast refresh, request handlers). Each
+# worker still imports the caller's main script as __mp_main__, so a script
+# that builds a pool at module level has to skip that outside the
+# MainProcess.
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+plogger = logging.getLogger("(render)")
+
+
+class RenderBusy(RuntimeError):
+    pass
+
+
+def _ready():
+    return os.getpid()
+
+
+class RenderPool:
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        # jobs allowed queued or in flight, beyond this callers get RenderBusy
+        self.max_pending = max_pending or self.workers * 2
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.submitted = 0
+        self.rejected = 0
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload(['plots'])
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self.executor
+
+    def start(self):
+        # brings every worker up now so the first render doesn't pay for the imports
+        for future in [self._executor().submit(_ready) for _ in range(self.workers)]:
+            future.result()
+        plogger.info(f"render pool up with {self.workers} worker(s), {self.max_pending} slot(s)")
+        return self
+
+    def _done(self, future):
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            plogger.error(f"render job failed: {future.exception()!r}")
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) on a worker and returns its Future.
+        Raises RenderBusy without waiting if every slot is taken.
+        """
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise RenderBusy(f"{self.max_pending} render job(s) already pending")
+        try:
+            future = self._executor().submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # a worker died (OOM, segfault), start over with a fresh pool
+            plogger.warning("render pool broken, restarting it")
+            with self.lock:
+                self.executor = None
+            try:
+                future = self._executor().submit(fn, *args, **kwargs)
+            except BaseException:
+                self.slots.release()
+                raise
+        except BaseException:
+            self.slots.release()
+            raise
+        self.submitted += 1
+        future.add_done_callback(self._done)
+        return future
+
+    def stats(self):
+        return {'workers': self.workers, 'max_pending': self.max_pending,
+                'submitted': self.submitted, 'rejected': self.rejected}
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
@@ -0,0 +1,345 @@
+# Pre-aggregated rollups of the raw readings.
+#
+# Week and month views can't afford to pull every raw row, so a
+# background job keeps 1-minute, 15-minute and hourly rollup tables with
+# count, min, max and sum (mean = sum / n) per PID and measure. Each
+# pass re-aggregates the buckets from a little before the last pass in
+# SQL with INSERT ... SELECT ... ON DUPLICATE KEY UPDATE, so the job is
+# idempotent. Rows a spool replays after a long outage are older than
+# that, so each pass also remembers the newest raw id it has seen and
+# recomputes the hours touched by any older-stamped row inserted since.
+# The very first pass rolls up all the history already in the raw tables.
+#
+# Every web app process may start a RollupJob, but only the one holding a
+# MySQL named lock runs a pass; the others read the watermark the holder
+# stored. Bucket edges are in UTC on both the Python and the SQL side.
+#
+# Run standalone:  python rollups.py --db_ip X.X.X.X --rebuild_days 30
+# or start a RollupJob thread inside another process (the web app does).
+
+import argparse
+import calendar
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mysql.connector
+
+import readings_store
+
+rlogger = logging.getLogger("(rollups)")
+
+MEASURES = ('temperature', 'humidity', 'wind_speed', 'soil_moisture')
+
+# bucket width in seconds -> rollup table, finest first
+RESOLUTIONS = (
+    (60, 'sensor_rollup_1m'),
+    (900, 'sensor_rollup_15m'),
+    (3600, 'sensor_rollup_1h'),
+)
+
+SOURCES = (readings_store.READINGS_TABLE,)
+
+# per source table, when the last pass ran and the newest raw id it had seen,
+# shared by every process running a RollupJob
+STATE_TABLE = 'sensor_rollup_state'
+# MySQL named lock, only its holder runs a pass
+LOCK_NAME = 'piSenseDB.rollups'
+
+
+def create_tables(cursor):
+    cols = ",\n".join(f"{m}_min FLOAT, {m}_max FLOAT, {m}_sum DOUBLE" for m in MEASURES)
+    for _, table in RESOLUTIONS:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                PID INT NOT NULL,
+                bucket DATETIME NOT NULL,
+                n INT NOT NULL,
+                {cols},
+                PRIMARY KEY (bucket, PID)
+            )
+        """)
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            name VARCHAR(64) NOT NULL PRIMARY KEY,
+            watermark DATETIME NOT NULL,
+            last_id BIGINT NULL
+        )
+    """)
+
+
+def read_state(cursor, sources=SOURCES):
+    """
+    (watermark, {source: last_id}). The watermark is the oldest over
+    sources, None until every source has one.
+    """
+    cursor.execute(f"SELECT name, watermark, last_id FROM {STATE_TABLE}")
+    rows = {name: (watermark, last_id) for name, watermark, last_id in cursor.fetchall()}
+    if any(source not in rows for source in sources):
+        return None, {}
+    return (min(rows[source][0] for source in sources),
+            {source: rows[source][1] for source in sources})
+
+
+def write_state(cursor, watermark, last_ids):
+    # last_ids maps source -> newest id seen, None keeps the stored id
+    for source, last_id in last_ids.items():
+        cursor.execute(f"""
+            INSERT INTO {STATE_TABLE} (name, watermark, last_id) VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE watermark = VALUES(watermark), last_id = COALESCE(VALUES(last_id), last_id)
+        """, (source, watermark, last_id))
+
+
+def newest_id(cursor, source):
+    cursor.execute(f"SELECT MAX(id) FROM {source}")
+    return cursor.fetchone()[0] or 0
+
+
+def late_hours(cursor, source, after, upto, before):
+    """
+    Starts (epoch seconds) of the hours holding a row of source with id in
+    (after, upto] stamped before `before`, i.e. rows inserted since the last
+    pass that the regular since window won't reach.
+    """
+    width = RESOLUTIONS[-1][0]
+    cursor.execute(f"""
+        SELECT DISTINCT FLOOR(UNIX_TIMESTAMP(timestamp) / {width}) * {width}
+        FROM {source} WHERE id > %s AND id <= %s AND timestamp < %s
+    """, (after, upto, before))
+    return sorted(int(row[0]) for row in cursor.fetchall())
+
+
+def oldest(cursor, sources=SOURCES):
+    # earliest raw timestamp across sources, None if they are all empty
+    stamps = []
+    for source in sources:
+        cursor.execute(f"SELECT MIN(timestamp) FROM {source}")
+        stamps.append(cursor.fetchone()[0])
+    stamps = [s for s in stamps if s is not None]
+    return min(stamps) if stamps else None
+
+
+def aggregate(cursor, source, seconds, table, since, until=None):
+    """
+    Recomputes every bucket of table from rows of source at or after since
+    (and before until, if given). Both must be aligned to the bucket width
+    so no bucket is half counted.
+    """
+    selects = ", ".join(f"MIN({m}), MAX({m}), SUM({m})" for m in MEASURES)
+    targets = ", ".join(f"{m}_min, {m}_max, {m}_sum" for m in MEASURES)
+    updates = ", ".join(f"{c} = VALUES({c})" for m in MEASURES for c in (f"{m}_min", f"{m}_max", f"{m}_sum"))
+    cursor.execute(f"""
+        INSERT INTO {table} (PID, bucket, n, {targets})
+        SELECT PID, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(timestamp) / {seconds}) * {seconds}) AS b,
+               COUNT(*), {selects}
+        FROM {source} WHERE timestamp >= %s{" AND timestamp < %s" if until else ""}
+        GROUP BY PID, b
+        ON DUPLICATE KEY UPDATE n = VALUES(n), {updates}
+    """, (since, until) if until else (since,))
+
+
+def pick_resolution(span, max_points=1500):
+    """
+    Finest rollup that keeps span (timedelta) under max_points buckets per PID.
+    Returns (seconds, table).
+    """
+    for seconds, table in RESOLUTIONS:
+        if span.total_seconds() / seconds <= max_points:
+            return seconds, table
+    return RESOLUTIONS[-1]
+
+
+def fetch_rollup(cursor, table, since, until=None):
+    """
+    Rollup rows in the raw row shape (PID, temperature, humidity, wind_speed,
+    soil_moisture, time) with each measure as its bucket mean.
+    """
+    means = ", ".join(f"{m}_sum / n" for m in MEASURES)
+    until = until or datetime.utcnow()
+    cursor.execute(f"""
+        SELECT PID, {means}, bucket FROM {table}
+        WHERE bucket >= %s AND bucket < %s ORDER BY bucket
+    """, (since, until))
+    return cursor.fetchall()
+
+
+def downsample(cursor, measure, since, until, points, sources=SOURCES):
+    """
+    measure between since and until, aggregated in SQL into at most points
+    buckets per PID. Reads the finest rollup no wider than the bucket, or the
+    raw tables when the bucket is narrower than a minute.
+
+    Returns (bucket seconds, rows of (PID, bucket start, mean, min, max)).
+    From a rollup the first bucket may start before since, and buckets after
+    the last RollupJob pass are not there yet.
+    """
+    if measure not in MEASURES:
+        raise ValueError(f"unknown measure {measure}")
+    span = max((until - since).total_seconds(), 1)
+    bucket = max(1, math.ceil(span / max(points, 1)))
+
+    rollup = None
+    for seconds, table in RESOLUTIONS:
+        if seconds <= bucket:
+            rollup = (seconds, table)
+    if rollup is not None:
+        # whole rollup buckets per output bucket keeps the means exact
+        bucket = math.ceil(bucket / rollup[0]) * rollup[0]
+        # start on a bucket edge so the first bucket is whole rather than missing the rows before since
+        cursor.execute(f"""
+            SELECT PID, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(bucket) / {bucket}) * {bucket}) AS b,
+                   SUM({measure}_sum) / SUM(n), MIN({measure}_min), MAX({measure}_max)
+            FROM {rollup[1]} WHERE bucket >= %s AND bucket < %s
+            GROUP BY PID, b ORDER BY b
+        """, (floor_time(since, bucket), until))
+    else:
+        raw = " UNION ALL ".join(
+            f"SELECT PID, {measure} AS v, timestamp FROM {source} WHERE timestamp >= %s AND timestamp < %s"
+            for source in sources)
+        cursor.execute(f"""
+            SELECT PID, FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(timestamp) / {bucket}) * {bucket}) AS b,
+                   AVG(v), MIN(v), MAX(v)
+            FROM ({raw}) AS r
+            GROUP BY PID, b ORDER BY b
+        """, (since, until) * len(sources))
+    return bucket, cursor.fetchall()
+
+
+def floor_time(ts, seconds):
+    # naive UTC in and out, never goes through the local timezone
+    epoch = calendar.timegm(ts.timetuple())
+    return datetime.utcfromtimestamp(epoch // seconds * seconds)
+
+
+class RollupJob:
+    def __init__(self, db_config, sources=SOURCES, interval=60, lateness=timedelta(hours=1),
+                 backfill_step=timedelta(days=1)):
+        self.db_config = db_config
+        self.sources = sources
+        self.interval = interval
+        # how far behind the previous pass to re-aggregate, covers late spooled rows
+        self.lateness = lateness
+        # first-pass backfill is committed in chunks this long
+        self.backfill_step = backfill_step
+        self.watermark = None
+        self.thread = None
+
+    def _connect(self):
+        # UTC session so SQL bucket edges match floor_time
+        return mysql.connector.connect(**{**self.db_config, 'time_zone': '+00:00'})
+
+    def run_once(self, since=None):
+        """
+        One pass if this process holds the rollup lock. Returns False if
+        another process does, after picking up the watermark it stored.
+        """
+        now = datetime.utcnow()
+        start = time.perf_counter()
+        with self._connect() as conn:
+            with conn.cursor() as cursor:
+                create_tables(cursor)
+                cursor.execute("SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+                if cursor.fetchone()[0] != 1:
+                    self.watermark = read_state(cursor, self.sources)[0]
+                    conn.commit()
+                    return False
+                try:
+                    # the daily partitions of the readings table ride along with each pass
+                    readings_store.create_table(cursor)
+                    readings_store.ensure_partitions(cursor)
+
+                    stored, last_ids = read_state(cursor, self.sources)
+                    # ids are read before aggregating, rows inserted during the pass are checked next time
+                    top = {source: newest_id(cursor, source) for source in self.sources}
+                    if since is None and stored is None:
+                        # first pass ever, roll up the history that was there before us
+                        since = oldest(cursor, self.sources) or now
+                        rlogger.info(f"no rollups yet, backfilling since {since}")
+                    elif since is None:
+                        since = stored - self.lateness
+                    # align to the widest bucket so every resolution recomputes whole buckets
+                    since = floor_time(since, RESOLUTIONS[-1][0])
+
+                    # long ranges go in chunks, each committed with its watermark so a restart resumes
+                    chunk = since
+                    while chunk + self.backfill_step < now:
+                        self._aggregate(cursor, self.sources, chunk, chunk + self.backfill_step)
+                        chunk += self.backfill_step
+                        write_state(cursor, chunk, {source: None for source in self.sources})
+                        conn.commit()
+                    self._aggregate(cursor, self.sources, chunk, None)
+                    late = self._late(cursor, last_ids, top, since)
+                    write_state(cursor, now, top)
+                    conn.commit()
+                finally:
+                    cursor.execute("DO RELEASE_LOCK(%s)", (LOCK_NAME,))
+        self.watermark = now
+        rlogger.info(f"rolled up since {since} plus {late} late hour(s) in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return True
+
+    def _aggregate(self, cursor, sources, since, until):
+        for source in sources:
+            for seconds, table in RESOLUTIONS:
+                aggregate(cursor, source, seconds, table, since, until)
+
+    def _late(self, cursor, last_ids, top, since):
+        # recompute the hours behind `since` that received rows since the last pass (spool replays)
+        width = RESOLUTIONS[-1][0]
+        count = 0
+        for source in self.sources:
+            if last_ids.get(source) is None:
+                # no id recorded yet, the backfill that just ran covered everything up to top
+                continue
+            hours = late_hours(cursor, source, last_ids[source] - readings_store.ID_LOOKBACK, top[source], since)
+            # runs of consecutive hours go in one statement per resolution
+            runs = []
+            for hour in hours:
+                if runs and runs[-1][1] == hour:
+                    runs[-1][1] = hour + width
+                else:
+                    runs.append([hour, hour + width])
+            for begin, end in runs:
+                self._aggregate(cursor, (source,), datetime.utcfromtimestamp(begin), datetime.utcfromtimestamp(end))
+            count += len(hours)
+        return count
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except mysql.connector.Error as e:
+                rlogger.error(f"rollup pass failed: {e}")
+            except Exception:
+                # never let one bad pass stop the rollups for good
+                rlogger.exception("rollup pass failed")
+            time.sleep(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="rollups", daemon=True)
+        self.thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        prog="rollups",
+        description="Maintains 1m/15m/1h rollups of the sensor readings.",
+        epilog="Example usage:\n python rollups.py --db_ip X.X.X.X --rebuild_days 30"
+    )
+    parser.add_argument("--db_ip", default="127.0.0.1", type=str, help="Enter IPv4 Address for database.")
+    parser.add_argument("--db_port", default=3306, type=int, help="Enter port number for database.")
+    parser.add_argument("--db_user", default="root", type=str, help="Enter user for database.")
+    parser.add_argument("--db_pass", default="", type=str, help="Enter password for user of database.")
+    parser.add_argument("--interval", default=60, type=int, help="Seconds between rollup passes.")
+    parser.add_argument("--rebuild_days", default=0, type=int, help="Backfill this many days of history before looping.")
+    args = parser.parse_args()
+
+    job = RollupJob({'host': args.db_ip, 'port': args.db_port, 'user': args.db_user,
+                     'password': args.db_pass, 'database': 'piSenseDB'}, interval=args.interval)
+    if args.rebuild_days:
+        job.run_once(since=datetime.utcnow() - timedelta(days=args.rebuild_days))
+    job._loop()
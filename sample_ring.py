@@ -0,0 +1,57 @@
+# Fixed-size ring buffer of sensor samples.
+#
+# The Secondary's sampling thread pushes one row per sample into a
+# preallocated NumPy array (epoch seconds plus one column per measure),
+# overwriting the oldest row once full. Readers get the newest sample or
+# every sample after a given epoch without the sampler ever allocating.
+
+import threading
+
+import numpy as np
+
+FIELDS = ('temperature', 'humidity', 'wind_speed', 'soil_moisture')
+
+
+class SampleRing:
+    def __init__(self, size=600):
+        if size < 1:
+            raise ValueError("ring size must be at least 1")
+        self.size = size
+        # column 0 is the epoch, NaN marks a missing reading
+        self.rows = np.full((size, 1 + len(FIELDS)), np.nan)
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def push(self, epoch, reading):
+        with self.lock:
+            row = self.rows[self.head]
+            row[0] = epoch
+            for i, field in enumerate(FIELDS, 1):
+                value = reading.get(field)
+                row[i] = np.nan if value is None else value
+            self.head = (self.head + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def _ordered(self):
+        # oldest to newest, copied so the sampler can keep writing
+        start = (self.head - self.count) % self.size
+        return np.take(self.rows, np.arange(start, start + self.count) % self.size, axis=0)
+
+    def since(self, epoch):
+        """
+        Samples newer than epoch, oldest first, as an (n, 5) array of
+        epoch plus FIELDS.
+        """
+        with self.lock:
+            rows = self._ordered()
+        return rows[rows[:, 0] > epoch]
+
+    def latest(self):
+        with self.lock:
+            if not self.count:
+                return None
+            return self.rows[(self.head - 1) % self.size].copy()
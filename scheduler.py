@@ -0,0 +1,55 @@
+# Deadline-based round pacing.
+#
+# Instead of sleeping a fixed amount after the work, each round is given a
+# deadline one period after the previous one and we only sleep for whatever
+# is left. Slow rounds eat into the sleep rather than stretching the period.
+
+import collections
+import time
+
+
+class RoundScheduler:
+    def __init__(self, hz, window=20):
+        if hz <= 0:
+            raise ValueError("round rate must be positive")
+        self.hz = hz
+        self.period = 1.0 / hz
+        self.next_deadline = None
+        self.rounds = 0
+        self.overruns = 0
+        # start times of recent rounds, used for the achieved rate
+        self.starts = collections.deque(maxlen=window)
+
+    def delay(self):
+        """
+        Seconds left until the next round is due, 0 if it is already late.
+        """
+        if self.next_deadline is None:
+            return 0.0
+        return max(0.0, self.next_deadline - time.monotonic())
+
+    def tick(self):
+        # marks the start of a round and sets the deadline for the next one
+        now = time.monotonic()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        elif now - self.next_deadline > self.period:
+            # fell more than a whole round behind, resync instead of bursting to catch up
+            self.overruns += 1
+            self.next_deadline = now
+        self.next_deadline += self.period
+        self.rounds += 1
+        self.starts.append(now)
+
+    def wait(self):
+        time.sleep(self.delay())
+        self.tick()
+
+    def achieved_hz(self):
+        if len(self.starts) < 2:
+            return 0.0
+        span = self.starts[-1] - self.starts[0]
+        return (len(self.starts) - 1) / span if span > 0 else 0.0
+
+    def report(self):
+        return f"{self.achieved_hz():.2f}/{self.hz:.2f} Hz achieved/target, {self.overruns} overruns"
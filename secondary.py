@@ -8,23 +8,21 @@ import selectors
 import logging
 import types
 import argparse
+import collections
+import signal
+import threading
+import time
 from time import sleep
-from datetime import datetime
 import json
+import numpy as np
+import sensors
+import wire
+from sample_ring import FIELDS, SampleRing
+from scheduler import RoundScheduler
 
 # TODO: Change to false when using real sensors
 TESTING = False
 
-if not TESTING:
-    import board
-    import busio
-    import simpleio
-    import adafruit_ads1x15.ads1015 as ADS
-    from adafruit_ads1x15.analog_in import AnalogIn
-    from adafruit_seesaw.seesaw import Seesaw
-    import adafruit_sht31d
-else:
-    import random
 
 
 # TODO: Improve logging
@@ -32,6 +30,16 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 slogger = logging.getLogger(f"(srv)")
 slogger.setLevel(level=logging.INFO)
 
+def positive_float(value: str):
+    # argparse type for intervals, zero or less would spin the select loop
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value}: Enter a number of seconds")
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value}: Enter a positive number of seconds")
+    return number
+
 def parse_args():
     parser = argparse.ArgumentParser(
         prog="secondary",
@@ -40,6 +48,16 @@ def parse_args():
     )
     parser.add_argument("--ip", default="127.0.0.1", type=str, help="Enter IPv4 Address to bind to.", required=False)
     parser.add_argument("--port", type=int, help="Enter port number to listen on.", required=True)
+    parser.add_argument("--sample_hz", default=1.0, type=float, help="Sensor samples per second taken in the background.")
+    parser.add_argument("--history", default=600, type=int, help="Number of recent samples kept for since= requests.")
+    parser.add_argument("--idle", default="exit", choices=("exit", "stay"), help="exit: shut down after --idle_timeout without connections. stay: run as a daemon.")
+    parser.add_argument("--idle_timeout", default=60, type=float, help="Seconds without a request before --idle applies.")
+    parser.add_argument("--max_conns", default=256, type=int, help="Open connections at which accepting pauses until one closes.")
+    parser.add_argument("--stats_interval", default=60, type=positive_float, help="Seconds between counter/latency reports.")
+    parser.add_argument("--push", default=None, type=str, help="Collector ip:port to push readings to (Primary --listen).")
+    parser.add_argument("--station_id", default=None, type=int, help="PID this station's pushed readings are stored under. Required with --push.")
+    parser.add_argument("--deadband", default=0.5, type=float, help="Push as soon as any measure moves more than this since the last push.")
+    parser.add_argument("--heartbeat", default=30, type=float, help="Push at least this often (seconds) even if nothing moved.")
 
     args = parser.parse_args()
 
@@ -53,10 +71,32 @@ def parse_args():
         slogger.error("--port: Enter a valid port in the range 1024-65535")
         raise RuntimeError("--port: Enter a valid port in the range 1024-65535")
 
-    return args.ip, args.port
+    if args.sample_hz <= 0 or args.history < 1:
+        raise RuntimeError("--sample_hz must be positive and --history at least 1")
+
+    if args.idle_timeout <= 0 or args.max_conns < 1:
+        raise RuntimeError("--idle_timeout must be positive and --max_conns at least 1")
+
+    push = None
+    if args.push is not None:
+        push_ip, sep, push_port = args.push.rpartition(':')
+        try:
+            socket.inet_aton(push_ip)
+            push = (push_ip, int(push_port))
+        except (OSError, ValueError):
+            raise RuntimeError("--push: Enter the collector as ip:port")
+        if args.station_id is None:
+            raise RuntimeError("--push: --station_id is required to push readings")
+        if args.deadband < 0 or args.heartbeat <= 0:
+            raise RuntimeError("--deadband must not be negative and --heartbeat must be positive")
+
+    return (args.ip, args.port, args.sample_hz, args.history,
+            args.idle, args.idle_timeout, args.max_conns, args.stats_interval,
+            push, args.station_id, args.deadband, args.heartbeat)
 
 class Secondary:
-    def __init__(self, host, port):
+    def __init__(self, host, port, sample_hz=1.0, history=600, idle="exit", idle_timeout=60, max_conns=256, stats_interval=60,
+                 push=None, station_id=None, deadband=0.5, heartbeat=30):
         slogger.debug("Initializing server...")
 
         # Set up selector.
@@ -65,7 +105,39 @@ class Secondary:
         # Set host and port and timeout duration.
         self.host = host
         self.port = port
-        self.timeout = 60
+        self.timeout = idle_timeout
+        # "exit" keeps the old behaviour of shutting down when nobody polls, "stay" runs until killed
+        self.idle = idle
+        self.max_conns = max_conns
+        if not stats_interval > 0:
+            raise ValueError("stats_interval must be a positive number of seconds")
+        self.stats_interval = stats_interval
+
+        # Accepting pauses while max_conns are open, the kernel backlog holds the rest
+        self.listen_sock = None
+        self.accepting = False
+        self.active = 0
+
+        # Counters and recent request-to-reply latencies (seconds) for the periodic report
+        self.counters = collections.Counter()
+        self.latencies = collections.deque(maxlen=2048)
+        self.last_request = time.monotonic()
+        self.last_report = time.monotonic()
+        self.sensor = sensors.get_driver(simulated=TESTING)
+
+        # Sensors are read by a background thread on its own schedule, requests
+        # are answered from the newest pre-encoded sample and the ring buffer
+        self.sampler = RoundScheduler(sample_hz)
+        self.samples = SampleRing(history)
+        self.latest = None
+        self.stop = threading.Event()
+
+        # Push mode: stream samples to a collector when they move past the deadband or the heartbeat is due
+        self.push = push
+        self.station_id = station_id
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+        self.new_sample = threading.Event()
 
         self.sht30 = {'temp': -1, 'hum': -1}
         self.seesaw = {'temp': -1, 'hum': -1}
@@ -77,67 +149,157 @@ class Secondary:
 
 
     def genData(self):
-        if not TESTING:
-            # create the I2C bus
-            i2c = busio.I2C(board.SCL, board.SDA)
-
-            # create the ADS object
-            ads = ADS.ADS1015(i2c)
-
-            # create the analog input channel for the anemometer on ADC pin(2)
-            chan = AnalogIn(ads, ADS.P2)
-
-            # create the Seesaw object for the soil moisture sensor
-            soil_sensor = Seesaw(i2c, addr=0x36)
-
-            # create the SHT31D object for the temperature and humidity sensor
-            temp_sensor = adafruit_sht31d.SHT31D(i2c)
-
-            # maps the voltage to wind speed via simpleio
-            voltage = chan.voltage
-            if voltage < 0.41:
-                wind_speed = 0
-            else:
-                wind_speed = simpleio.map_range(voltage, 0.4, 2, 0, 32.4)
-
-            SHT30_temp = temp_sensor.temperature
-            SHT30_hum = temp_sensor.relative_humidity
-
-            soil_moist = soil_sensor.moisture_read()
-
-            data = {
-                'temperature': SHT30_temp,
-                'humidity': SHT30_hum,
-                'wind_speed': wind_speed,
-                'soil_moisture': soil_moist,
-                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-        else:
-            data = {
-                'temperature': random.randrange(0, 20),
-                'humidity': random.randrange(0, 20),
-                'wind_speed': random.randrange(0, 20),
-                'soil_moisture': random.randrange(0, 20),
-                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-
-        return data
+        # Sensor handles are cached by the shared driver, TESTING selects the simulated backend
+        return sensors.read_measures(self.sensor)
+
+    def sample(self):
+        # One sensor read, kept in the ring and encoded once for every request until the next
+        data = self.genData()
+        self.samples.push(time.time(), data)
+        self.latest = json.dumps(data).encode()
+        self.new_sample.set()
+
+    def sample_loop(self):
+        while not self.stop.is_set():
+            self.sampler.wait()
+            try:
+                self.sample()
+            except Exception as e:
+                slogger.error(f"Sensor sample failed: {e}")
 
     def genMsg(self):
-        msg = self.genData()
+        msg = self.latest
 
         if msg is None:
             return b"Error: No data received\n"
         else:
-            return json.dumps(msg).encode()
+            return msg
+
+    def sampleDict(self, row):
+        # Ring row (epoch, measures...) back to the reading dict, with the epoch for since=
+        data = {field: (None if row[i] != row[i] else float(row[i])) for i, field in enumerate(FIELDS, 1)}
+        data['timestamp'] = sensors.utc_stamp(row[0])
+        data['epoch'] = float(row[0])
+        return data
 
-    def valid_request(self, data):
-        return True if data == b'Requesting data\n' else False
+    def genHistory(self, since):
+        # Every buffered sample after epoch `since`, oldest first, with epochs for the next since=
+        history = [self.sampleDict(row) for row in self.samples.since(since)]
+        return json.dumps(history).encode()
+
+    def moved(self, values, last):
+        # True if any measure changed by more than the deadband, or appeared/disappeared
+        if last is None or np.any(np.isnan(values) != np.isnan(last)):
+            return True
+        diff = np.abs(values - last)
+        diff = diff[~np.isnan(diff)]
+        return bool(diff.size) and diff.max() > self.deadband
+
+    def select_pushes(self, rows, last_values, last_push):
+        # Samples in rows worth sending: moved past the deadband, or a heartbeat since the last one sent
+        picked = []
+        for row in rows:
+            values = row[1:]
+            if self.moved(values, last_values) or last_push is None or row[0] - last_push >= self.heartbeat:
+                picked.append(row)
+                last_values, last_push = values, row[0]
+        return picked, last_values, last_push
+
+    def recv_acks(self, conn, count):
+        # The collector answers every frame it has queued with one ACK byte
+        got = 0
+        while got < count:
+            data = conn.recv(count - got)
+            if not data:
+                raise ConnectionError("collector closed the stream")
+            if data.strip(wire.ACK):
+                raise ConnectionError(f"unexpected reply from collector: {data!r}")
+            got += len(data)
+
+    def push_loop(self):
+        """
+        Streams samples to the collector as length-prefixed JSON frames, each
+        a reading dict plus 'station' and 'epoch'. Only samples that moved past
+        the deadband are sent, plus one per heartbeat so the collector knows
+        we're alive. Every frame is acked, and the resend point only moves once
+        it is, so after an outage or a backoff the samples buffered in the ring
+        since the last ack are picked the same way and sent before new ones.
+        Reconnects with backoff if the collector goes away.
+        """
+        conn = None
+        backoff = 1
+        # newest sample considered, plus the values and epoch of the last one pushed, all as of the last ack
+        acked = None
+        last_values = None
+        last_push = None
+
+        while not self.stop.is_set():
+            self.new_sample.wait(timeout=self.heartbeat)
+            self.new_sample.clear()
+            rows = self.samples.since(-np.inf if acked is None else acked)
+            if not len(rows):
+                continue
+            picked, values, pushed = self.select_pushes(rows, last_values, last_push)
+            if not picked:
+                # nothing moved, no need to touch the collector
+                acked = rows[-1][0]
+                continue
+
+            try:
+                if conn is None:
+                    conn = socket.create_connection(self.push, timeout=5)
+                    slogger.info(f"Pushing to collector at {self.push[0]}:{self.push[1]}.")
+                for row in picked:
+                    sample = self.sampleDict(row)
+                    sample['station'] = self.station_id
+                    wire.send_frame(conn, json.dumps(sample).encode())
+                self.recv_acks(conn, len(picked))
+            except OSError as e:
+                slogger.warning(f"Push to {self.push[0]}:{self.push[1]} failed, "
+                                f"{len(picked)} sample(s) kept for resend, retrying in {backoff}s: {e}")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                self.stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+
+            backoff = 1
+            acked, last_values, last_push = rows[-1][0], values, pushed
+            self.counters['pushed'] += len(picked)
+            # A reachable collector counts as activity for the idle shutdown
+            self.last_request = time.monotonic()
+
+        if conn is not None:
+            conn.close()
+
+    def parse_request(self, data):
+        """
+        b'Requesting data\\n' for the latest sample, or
+        b'Requesting data since=<epoch>\\n' for the buffered history.
+        Returns the reply, or None for an invalid request.
+        """
+        if data == b'Requesting data\n':
+            return self.genMsg()
+        if data.startswith(b'Requesting data since=') and data.endswith(b'\n'):
+            try:
+                since = float(data[len(b'Requesting data since='):-1])
+            except ValueError:
+                return None
+            return self.genHistory(since)
+        return None
 
     # Run function.
     def run(self):
 
         slogger.debug("Starting server...")
+        # First sample inline so there is always something to serve, the thread keeps it fresh
+        self.sample()
+        self.sampler.tick()
+        threading.Thread(target=self.sample_loop, name="sampler", daemon=True).start()
+        if self.push is not None:
+            threading.Thread(target=self.push_loop, name="pusher", daemon=True).start()
+
         # Set, bind, and set to listen ports.
         slogger.debug("\tSetting socket...")
 
@@ -145,22 +307,31 @@ class Secondary:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((self.host, self.port))
 
-        sock.listen()
+        # Deep backlog so a burst of pollers isn't refused while we drain the accept queue
+        sock.listen(512)
         slogger.info(f"Listening from port {self.port}.")
         sock.setblocking(False)
 
         # Register the socket to be monitored.
-        self.sel.register(sock, selectors.EVENT_READ, data=None)
+        self.listen_sock = sock
+        self.resume_accepting()
         slogger.debug("Monitoring set.")
 
+        # A service manager stops us with SIGTERM, unwind the same way as Ctrl-C
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+
         # Event loop.
+        idle_logged = False
+        reported = 0
+        self.last_request = time.monotonic()
         try:
             while True:
-                events = self.sel.select(timeout=self.timeout)
-
-                if not events:
-                    self.sel.close()
-                    raise RuntimeError(f"No connections recevied in last {self.timeout} seconds. Shutting Down.")
+                # Wake for the idle deadline (until it has fired once) and the next report
+                wakes = [] if idle_logged else [self.last_request + self.timeout]
+                wakes.append(self.last_report + self.stats_interval)
+                timeout = max(0.0, min(wakes) - time.monotonic())
+                events = self.sel.select(timeout=timeout)
 
                 for key, mask in events:
                     if key.data is None:
@@ -168,25 +339,98 @@ class Secondary:
                     else:
                         self.service_connection(key, mask)
 
+                now = time.monotonic()
+                if now - self.last_report >= self.stats_interval:
+                    # Quiet periods don't repeat the same line
+                    if self.counters['accepted'] != reported:
+                        self.report()
+                        reported = self.counters['accepted']
+                    self.last_report = now
+
+                if now - self.last_request >= self.timeout:
+                    if self.idle == "exit":
+                        raise RuntimeError(f"No requests recevied in last {self.timeout} seconds. Shutting Down.")
+                    if not idle_logged:
+                        slogger.warning(f"No requests received in last {self.timeout} seconds, staying up.")
+                        idle_logged = True
+                elif idle_logged:
+                    slogger.info("Polling resumed.")
+                    idle_logged = False
+
         except KeyboardInterrupt:
             slogger.info("Caught keyboard interrupt, exiting...")
         finally:
+            self.stop.set()
+            self.report()
             self.sel.close()
+            sock.close()
+
+    def pause_accepting(self):
+        if self.accepting:
+            self.sel.unregister(self.listen_sock)
+            self.accepting = False
+            self.counters['paused'] += 1
+            slogger.warning(f"{self.active} connections open, pausing accept.")
+
+    def resume_accepting(self):
+        if not self.accepting:
+            self.sel.register(self.listen_sock, selectors.EVENT_READ, data=None)
+            self.accepting = True
+
+    def percentile(self, q):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self):
+        return {
+            'accepted': self.counters['accepted'],
+            'served': self.counters['served'],
+            'invalid': self.counters['invalid'],
+            'errors': self.counters['errors'],
+            'paused': self.counters['paused'],
+            'pushed': self.counters['pushed'],
+            'active': self.active,
+            'p50_ms': self.percentile(0.50) * 1000,
+            'p99_ms': self.percentile(0.99) * 1000,
+        }
+
+    def report(self):
+        s = self.stats()
+        slogger.info(f"accepted {s['accepted']}, served {s['served']}, invalid {s['invalid']}, errors {s['errors']}, "
+                     f"open {s['active']}, accept paused {s['paused']}x, pushed {s['pushed']}, "
+                     f"latency p50 {s['p50_ms']:.2f} ms p99 {s['p99_ms']:.2f} ms")
 
     # Helper functions for accepting wrappers, servicing connections, and closing.
+    #
+    # Each connection is a small state machine driven by the selector:
+    #   READING  registered for EVENT_READ only, frames are parsed as bytes arrive
+    #   WRITING  replies are queued in outb, EVENT_WRITE is on until they have all gone out
+    #   and back to READING, a session stays open for more requests until the client hangs up
+    # Idle connections are never writable-interested, so the loop sleeps in select.
     def accept_wrapper(self, sock):
         """
         Accepts and registers new connections.
         """
-        conn, addr = sock.accept()
+        try:
+            conn, addr = sock.accept()
+        except BlockingIOError:
+            # another event already took it
+            return
         slogger.debug(f"Accepted connection from {addr}.")
+        self.counters['accepted'] += 1
         # Disable blocking.
         conn.setblocking(False)
-        # Create data object to monitor for read and write availability.
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        # Register connection with selector.
-        self.sel.register(conn, events, data=data)
+        # inb parses frames incrementally, outb holds unsent reply bytes, sent counts how far we got,
+        # pending counts replies in outb, started is when the oldest of their requests completed
+        data = types.SimpleNamespace(addr=addr, inb=wire.FrameBuffer(), outb=b"", sent=0, pending=0,
+                                     started=None)
+        # Register connection with selector, read interest only until there is something to send.
+        self.sel.register(conn, selectors.EVENT_READ, data=data)
+        self.active += 1
+        if self.active >= self.max_conns:
+            self.pause_accepting()
 
     def service_connection(self, key:selectors.SelectorKey, mask):
         slogger.debug(f"Servicing connection from: {key}, {mask}")
@@ -195,33 +439,92 @@ class Secondary:
         # Check for reads or writes.
 
         if mask & selectors.EVENT_READ:
-            recv_data = sock.recv(1024)
-            if recv_data:
-                data.outb += recv_data
-            else:
-                slogger.debug(f"Closing connection to {data.addr}")
-                self.sel.unregister(sock)
-                sock.close()
-
-        if mask & selectors.EVENT_WRITE:
-            if data.outb:
-                # NOTE Event handling code below
-
-
-
-                if self.valid_request(data.outb):
-                    print("Valid request")
-                    resp = self.genMsg()
-
-                    sock.sendall(resp)
-                else:
-                    print("Invalid request")
-
-
-
+            try:
+                recv_data = sock.recv(4096)
+            except BlockingIOError:
+                recv_data = None
+            except OSError as e:
+                slogger.debug(f"Connection to {data.addr} failed: {e}")
+                self.counters['errors'] += 1
+                self.unregister_and_close(sock)
+                return
 
-                # Unregister and close socket.
+            if recv_data == b"":
+                slogger.debug(f"Closing connection to {data.addr}")
                 self.unregister_and_close(sock)
+                return
+
+            if recv_data:
+                # Requests are length-prefixed frames, buffer until one is complete
+                data.inb.feed(recv_data)
+                try:
+                    requests = data.inb.frames()
+                except wire.FrameError as e:
+                    slogger.error(f"Bad frame from {data.addr}: {e}")
+                    self.counters['invalid'] += 1
+                    self.unregister_and_close(sock)
+                    return
+
+                if requests:
+                    # Sessions stay open, so idleness is judged by requests rather than accepts
+                    self.last_request = time.monotonic()
+                    if data.started is None:
+                        data.started = time.perf_counter()
+                    # Pipelined requests are answered in order with one send
+                    replies = []
+                    for request in requests:
+                        resp = self.parse_request(request)
+                        if resp is None:
+                            slogger.info(f"Invalid request from {data.addr}")
+                            self.counters['invalid'] += 1
+                            self.unregister_and_close(sock)
+                            return
+                        replies.append(wire.encode(resp))
+                    slogger.debug(f"{len(replies)} valid request(s) from {data.addr}")
+                    self.queue_reply(key, b"".join(replies), len(replies))
+                    return
+
+        if mask & selectors.EVENT_WRITE and data.outb:
+            self.flush(key)
+
+    def queue_reply(self, key, payload, count=1):
+        data = key.data
+        # Anything still unsent from earlier replies goes first
+        data.outb = data.outb[data.sent:] + payload if data.outb else payload
+        data.sent = 0
+        data.pending += count
+        # Most replies fit the socket buffer, try right away and only wait on EVENT_WRITE for the rest
+        self.flush(key)
+
+    def flush(self, key):
+        sock = key.fileobj
+        data = key.data
+        try:
+            data.sent += sock.send(memoryview(data.outb)[data.sent:])
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            slogger.debug(f"Send to {data.addr} failed: {e}")
+            self.counters['errors'] += 1
+            self.unregister_and_close(sock)
+            return
+
+        if data.sent < len(data.outb):
+            # Partial write, come back when the socket drains
+            if key.events != selectors.EVENT_READ | selectors.EVENT_WRITE:
+                self.sel.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=data)
+            return
+
+        data.outb = b""
+        data.sent = 0
+        self.counters['served'] += data.pending
+        data.pending = 0
+        if data.started is not None:
+            self.latencies.append(time.perf_counter() - data.started)
+            data.started = None
+        # Session stays open, back to waiting for the next request
+        if key.events & selectors.EVENT_WRITE:
+            self.sel.modify(sock, selectors.EVENT_READ, data=data)
 
     def unregister_and_close(self, sock:socket.socket):
         slogger.debug("Closing connection...")
@@ -235,11 +538,16 @@ class Secondary:
             sock.close()
         except OSError as e:
             slogger.error(f"Socket could not close:\n{e}")
+        self.active -= 1
+        if self.active < self.max_conns:
+            self.resume_accepting()
 
 if __name__ == "__main__":
-    host, port = parse_args()
+    (host, port, sample_hz, history, idle, idle_timeout, max_conns, stats_interval,
+     push, station_id, deadband, heartbeat) = parse_args()
 
-    secondary = Secondary(host, port)
+    secondary = Secondary(host, port, sample_hz, history, idle, idle_timeout, max_conns, stats_interval,
+                          push, station_id, deadband, heartbeat)
     secondary.run()
 
 
@@ -0,0 +1,209 @@
+# Shared sensor driver for every peer in the weather station.
+#
+# Building the I2C bus and the ADS1015/Seesaw/SHT31D objects takes tens of
+# milliseconds, so the handles are created once and cached for the life of
+# the process. They are only rebuilt after an I/O error.
+
+import argparse
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+slogger = logging.getLogger("(sensors)")
+
+# everything a read can return, callers ask for the subset they store
+FIELDS = ('temperature', 'humidity', 'wind_speed', 'soil_moisture', 'soil_temp')
+# the four measures the polling peers store, no soil temperature
+MEASURES = FIELDS[:4]
+
+# readings are stamped naive UTC in this format, the web app and rollups read them back as UTC
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def wind_speed_from_voltage(voltage):
+    # maps the anemometer voltage to wind speed (same curve as simpleio.map_range)
+    if voltage < 0.41:
+        return 0
+    voltage = min(voltage, 2)
+    return (voltage - 0.4) * (32.4 - 0) / (2 - 0.4)
+
+
+def utc_stamp(epoch=None):
+    # timestamp string for epoch seconds, or for now
+    when = datetime.utcnow() if epoch is None else datetime.utcfromtimestamp(epoch)
+    return when.strftime(TIME_FORMAT)
+
+
+def read_measures(driver):
+    """
+    One reading of MEASURES plus its 'timestamp', the dict the Primary
+    and Secondary store and send. Soil temperature is left out, it would
+    be an extra I2C read nobody stores.
+    """
+    reading = driver.read(MEASURES)
+    reading['timestamp'] = utc_stamp()
+    return reading
+
+
+class HardwareBackend:
+    """
+    Reads the SHT30, Seesaw and anemometer over a cached I2C bus.
+    """
+    def __init__(self):
+        self.handles = None
+
+    def open(self):
+        # Driver imports are deferred so the simulated backend runs without Blinka
+        import board
+        import busio
+        import adafruit_ads1x15.ads1015 as ADS
+        from adafruit_ads1x15.analog_in import AnalogIn
+        from adafruit_seesaw.seesaw import Seesaw
+        import adafruit_sht31d
+
+        # create the I2C bus
+        i2c = busio.I2C(board.SCL, board.SDA)
+
+        # create the ADS object
+        ads = ADS.ADS1015(i2c)
+
+        # create the analog input channel for the anemometer on ADC pin(2)
+        chan = AnalogIn(ads, ADS.P2)
+
+        # create the Seesaw object for the soil moisture sensor
+        soil_sensor = Seesaw(i2c, addr=0x36)
+
+        # create the SHT31D object for the temperature and humidity sensor
+        temp_sensor = adafruit_sht31d.SHT31D(i2c)
+
+        self.handles = (i2c, chan, soil_sensor, temp_sensor)
+
+    def close(self):
+        if self.handles is None:
+            return
+        try:
+            self.handles[0].deinit()
+        except Exception as e:
+            slogger.debug(f"I2C bus could not be released: {e}")
+        self.handles = None
+
+    def read(self, fields=FIELDS):
+        if self.handles is None:
+            self.open()
+        _, chan, soil_sensor, temp_sensor = self.handles
+
+        # every field is its own I2C transaction, so only the requested ones are read
+        readers = {
+            'temperature': lambda: temp_sensor.temperature,
+            'humidity': lambda: temp_sensor.relative_humidity,
+            'wind_speed': lambda: wind_speed_from_voltage(chan.voltage),
+            'soil_moisture': soil_sensor.moisture_read,
+            'soil_temp': soil_sensor.get_temp,
+        }
+        return {field: readers[field]() for field in fields}
+
+
+class SimulatedBackend:
+    """
+    Produces random readings in place of the sensors.
+
+    init_delay emulates the cost of bringing up the bus so the cached and
+    uncached paths can be compared without hardware.
+    """
+    def __init__(self, init_delay=0.0, seed=None):
+        self.init_delay = init_delay
+        self.rng = random.Random(seed)
+        self.handles = None
+
+    def open(self):
+        if self.init_delay:
+            time.sleep(self.init_delay)
+        self.handles = True
+
+    def close(self):
+        self.handles = None
+
+    def read(self, fields=FIELDS):
+        if self.handles is None:
+            self.open()
+
+        return {field: self.rng.randrange(0, 20) for field in fields}
+
+
+class SensorDriver:
+    """
+    Thread-safe front end over a backend. Keeps the handles open between
+    reads and rebuilds them once if a read fails with an I/O error.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.reinits = 0
+
+    def read(self, fields=FIELDS):
+        """
+        Returns {field: value} for the requested fields only.
+        """
+        with self.lock:
+            try:
+                return self.backend.read(fields)
+            except OSError as e:
+                slogger.warning(f"Sensor read failed, reinitialising bus: {e}")
+                self.backend.close()
+                self.reinits += 1
+                return self.backend.read(fields)
+
+    def close(self):
+        with self.lock:
+            self.backend.close()
+
+
+_driver = None
+_driver_lock = threading.Lock()
+
+def get_driver(simulated=False):
+    """
+    Returns the process-wide driver, creating it on first use.
+    """
+    global _driver
+    with _driver_lock:
+        if _driver is None:
+            backend = SimulatedBackend() if simulated else HardwareBackend()
+            _driver = SensorDriver(backend)
+        return _driver
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="sensors",
+        description="Benchmarks cached sensor handles against re-initialising the bus on every read.",
+        epilog="Example usage:\n python sensors.py --simulate --samples 200 --init_delay 0.03"
+    )
+    parser.add_argument("--simulate", action="store_true", help="Use the simulated backend instead of the I2C sensors.")
+    parser.add_argument("--samples", default=200, type=int, help="Number of reads per run.")
+    parser.add_argument("--init_delay", default=0.03, type=float, help="Simulated bus bring-up cost in seconds.")
+    args = parser.parse_args()
+
+    def make_backend():
+        return SimulatedBackend(init_delay=args.init_delay) if args.simulate else HardwareBackend()
+
+    # Uncached: fresh handles for every sample, as the peers used to do
+    start = time.perf_counter()
+    for _ in range(args.samples):
+        backend = make_backend()
+        backend.read()
+        backend.close()
+    uncached = (time.perf_counter() - start) / args.samples
+
+    # Cached: one driver for the whole run
+    driver = SensorDriver(make_backend())
+    start = time.perf_counter()
+    for _ in range(args.samples):
+        driver.read()
+    cached = (time.perf_counter() - start) / args.samples
+    driver.close()
+
+    print(f"uncached: {uncached * 1000:.3f} ms/read")
+    print(f"cached:   {cached * 1000:.3f} ms/read")
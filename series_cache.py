@@ -0,0 +1,270 @@
+# In-process time-series cache for the web app.
+#
+# Keeps the last `window` of rows for every readings table in memory.
+# A refresh only asks MySQL for rows whose id is past the newest id
+# already cached (less a small look-back for writers committing out of
+# id order), and rows that fall out of the window are evicted from the
+# front, so each dashboard hit costs one small incremental query at most
+# instead of a full 24 hour scan per table. Going by id rather than by
+# timestamp also picks up old rows that a spool replays late; those are
+# sorted into place instead of appended.
+#
+# Rows are stored column-wise in NumPy arrays (int32 PID, int64 epoch
+# seconds, float32 per measure). Each fetchmany batch of cursor tuples is
+# converted once into a float64 block and written into those arrays, and
+# snapshot() hands the arrays to pandas with copy=False (pandas 2+ keeps
+# them as they are instead of consolidating), so a plot reads the cache
+# itself rather than a copy of Python rows.
+
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import mysql.connector
+import numpy as np
+import pandas as pd
+
+from readings_store import ID_LOOKBACK, READINGS_TABLE
+
+MEASURES = ('temperature', 'humidity', 'wind_speed', 'soil_moisture')
+COLUMNS = ('PID',) + MEASURES + ('time',)
+
+
+def to_epoch(ts):
+    # naive UTC datetime -> epoch seconds
+    return int(ts.replace(tzinfo=timezone.utc).timestamp())
+
+
+class Columns:
+    """
+    Growable column store for one table. Rows live in [start, end) of the
+    arrays. Filled slots are never written again, growing or compacting
+    always moves to fresh arrays, so a snapshot stays valid after later
+    refreshes without being copied.
+    """
+    def __init__(self, capacity=1024):
+        self.pid = np.empty(capacity, np.int32)
+        self.ts = np.empty(capacity, np.int64)
+        self.values = np.empty((len(MEASURES), capacity), np.float32)
+        self.ids = np.empty(capacity, np.int64)
+        self.start = 0
+        self.end = 0
+        # rows ever appended at the newest end, lets readers ask for everything after a point they saw
+        self.appended = 0
+        # late rows sorted into the middle, not part of `appended`
+        self.late = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _allocate(self, capacity):
+        self.pid = np.empty(capacity, np.int32)
+        self.ts = np.empty(capacity, np.int64)
+        self.values = np.empty((len(MEASURES), capacity), np.float32)
+        self.ids = np.empty(capacity, np.int64)
+
+    def _reserve(self, n):
+        if self.end + n <= len(self.ts):
+            return
+        live = len(self)
+        capacity = len(self.ts)
+        while live + n > capacity:
+            capacity *= 2
+        pid, ts, values, ids = self.view()
+        self._allocate(capacity)
+        self.pid[:live] = pid
+        self.ts[:live] = ts
+        self.values[:, :live] = values
+        self.ids[:live] = ids
+        self.start, self.end = 0, live
+
+    def newest(self):
+        return int(self.ts[self.end - 1]) if len(self) else None
+
+    def append(self, block):
+        # block is an (n, 7) float64 array in SELECT order: PID, measures..., epoch, id
+        n = len(block)
+        self._reserve(n)
+        s = slice(self.end, self.end + n)
+        self.pid[s] = block[:, 0]
+        self.values[:, s] = block[:, 1:5].T
+        self.ts[s] = block[:, 5]
+        self.ids[s] = block[:, 6]
+        self.end += n
+        self.appended += n
+
+    def merge(self, block):
+        # late rows older than the newest cached one, sorted into place on fresh arrays
+        pid, ts, values, ids = self.view()
+        order = np.argsort(np.concatenate((ts, block[:, 5].astype(np.int64))), kind='stable')
+        live = len(ts) + len(block)
+        capacity = len(self.ts)
+        while live > capacity:
+            capacity *= 2
+        self._allocate(capacity)
+        self.pid[:live] = np.concatenate((pid, block[:, 0].astype(np.int32)))[order]
+        self.ts[:live] = np.concatenate((ts, block[:, 5].astype(np.int64)))[order]
+        self.values[:, :live] = np.concatenate((values, block[:, 1:5].T.astype(np.float32)), axis=1)[:, order]
+        self.ids[:live] = np.concatenate((ids, block[:, 6].astype(np.int64)))[order]
+        self.start, self.end = 0, live
+        self.late += len(block)
+
+    def recent_ids(self, after):
+        ids = self.ids[self.start:self.end]
+        return ids[ids > after]
+
+    def evict(self, cutoff):
+        # rows are in timestamp order, so everything before cutoff is a prefix
+        self.start += int(np.searchsorted(self.ts[self.start:self.end], cutoff))
+
+    def view(self):
+        s = slice(self.start, self.end)
+        return self.pid[s], self.ts[s], self.values[:, s], self.ids[s]
+
+    def frame(self, last=None):
+        # the newest `last` rows only, or every row
+        pid, ts, values, _ = self.view()
+        if last is not None:
+            last = min(last, len(pid))
+            pid, ts, values = pid[len(pid) - last:], ts[len(ts) - last:], values[:, values.shape[1] - last:]
+        data = {'PID': pid}
+        for i, measure in enumerate(MEASURES):
+            data[measure] = values[i]
+        # int64 epoch seconds reinterpreted as datetime64[s], no conversion pass
+        data['time'] = ts.view('datetime64[s]')
+        return pd.DataFrame(data, copy=False)
+
+
+class SeriesCache:
+    def __init__(self, db_config, tables=(READINGS_TABLE,),
+                 window=timedelta(days=1), min_refresh=1.0, fetch_batch=4096):
+        self.db_config = db_config
+        self.tables = tables
+        self.window = window
+        # refreshes closer together than this are served from memory
+        self.min_refresh = min_refresh
+        # rows pulled from the cursor per fetchmany
+        self.fetch_batch = fetch_batch
+
+        self.lock = threading.Lock()
+        self.conn = None
+        self.last_refresh = 0.0
+        # per table: cached columns and the newest id fetched
+        self.columns = {t: Columns() for t in tables}
+        self.last_id = {t: None for t in tables}
+
+    def _connect(self):
+        if self.conn is None:
+            # autocommit, otherwise REPEATABLE READ pins every refresh to the first SELECT's snapshot.
+            # time_zone is a connect option so ping(reconnect=True) sets it again, UNIX_TIMESTAMP and
+            # FROM_UNIXTIME then treat the naive DATETIMEs as UTC on every connection
+            self.conn = mysql.connector.connect(**{**self.db_config, 'autocommit': True, 'time_zone': '+00:00'})
+        else:
+            self.conn.ping(reconnect=True, attempts=1)
+        return self.conn
+
+    def _fetch(self, cursor, table, since):
+        columns = self.columns[table]
+        last_id = self.last_id[table]
+        after = -1 if last_id is None else last_id - ID_LOOKBACK
+        cursor.execute(f"""
+            SELECT PID, temperature, humidity, wind_speed, soil_moisture, UNIX_TIMESTAMP(timestamp), id
+            FROM {table} WHERE id > %s AND timestamp >= FROM_UNIXTIME(%s) ORDER BY timestamp
+        """, (after, since))
+
+        blocks = []
+        while True:
+            batch = cursor.fetchmany(self.fetch_batch)
+            if not batch:
+                break
+            # NULL measures come through as NaN
+            blocks.append(np.array(batch, dtype=np.float64))
+        if not blocks:
+            return 0
+        block = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+
+        if last_id is not None:
+            # the look-back re-reads a few rows we already hold
+            block = block[~np.isin(block[:, 6].astype(np.int64), columns.recent_ids(after))]
+            if not len(block):
+                return 0
+        self.last_id[table] = max(last_id or 0, int(block[:, 6].max()))
+
+        # rows at or after the newest cached timestamp extend the end, older ones were replayed late
+        newest = columns.newest()
+        tail = block[:, 5] >= newest if newest is not None else np.ones(len(block), bool)
+        columns.append(block[tail])
+        if not tail.all():
+            columns.merge(block[~tail])
+        return len(block)
+
+    def refresh(self):
+        """
+        Pulls rows newer than the cache and evicts rows older than the window.
+        Returns the number of new rows.
+        """
+        with self.lock:
+            if time.monotonic() - self.last_refresh < self.min_refresh:
+                return 0
+
+            since = to_epoch(datetime.utcnow() - self.window)
+            new = 0
+            try:
+                cursor = self._connect().cursor()
+                for table in self.tables:
+                    new += self._fetch(cursor, table, since)
+                cursor.close()
+            except mysql.connector.Error:
+                # drop the connection, the next refresh reconnects
+                self.conn = None
+                raise
+
+            for columns in self.columns.values():
+                columns.evict(since)
+
+            self.last_refresh = time.monotonic()
+            return new
+
+    def snapshot(self):
+        """
+        Every cached row as a DataFrame with COLUMNS. The columns are the
+        cache arrays themselves, which are never written again once filled.
+        """
+        with self.lock:
+            frames = [columns.frame() for columns in self.columns.values()]
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+
+    def since(self, seq):
+        """
+        Rows appended after seq as a DataFrame, plus the seq to pass next
+        time. seq None starts from the current end, returning no rows.
+        Rows already evicted are skipped.
+        """
+        with self.lock:
+            frames = []
+            now = {}
+            for table, columns in self.columns.items():
+                now[table] = columns.appended
+                if seq is not None:
+                    frames.append(columns.frame(last=columns.appended - seq.get(table, 0)))
+        if not frames:
+            return None, now
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0], now
+
+    def version(self):
+        """
+        Changes whenever the cached rows do: per table the oldest and newest
+        timestamp, the row count and the late rows merged so far. Newest
+        alone misses eviction at the front and late rows sorted into the middle.
+        """
+        with self.lock:
+            return tuple((int(c.ts[c.start]) if len(c) else None, c.newest(), len(c), c.late)
+                         for c in self.columns.values())
+
+    def latest(self):
+        # newest timestamp across all tables, changes whenever new data arrives
+        with self.lock:
+            stamps = [c.newest() for c in self.columns.values() if c.newest() is not None]
+            return datetime.utcfromtimestamp(max(stamps)) if stamps else None
@@ -0,0 +1,144 @@
+# Append-only, memory-mapped spool of readings.
+#
+# Collectors append every row here before anything touches MySQL, so an
+# outage never drops data. Records are fixed width so appending is a
+# struct pack into the mapped file, and the drain side can slice out a
+# whole batch by offset.
+#
+# Layout:
+#   header  MAGIC | write offset | read offset
+#   records epoch ts | PID | table number | temperature | humidity | wind speed | soil moisture
+
+import math
+import mmap
+import os
+import struct
+import threading
+from datetime import datetime, timezone
+
+MAGIC = b"PISPOOL1"
+HEADER = struct.Struct("<8sQQ")
+RECORD = struct.Struct("<dHH4x4d")
+HEADER_SIZE = 64
+
+TABLE_PREFIX = "sensor_readings"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def table_number(table):
+    # sensor_readingsN -> N, the bare prefix maps to 0
+    suffix = table[len(TABLE_PREFIX):]
+    if not table.startswith(TABLE_PREFIX) or (suffix and not suffix.isdigit()):
+        raise ValueError(f"{table} is not a readings table")
+    return int(suffix) if suffix else 0
+
+
+def table_name(number):
+    return f"{TABLE_PREFIX}{number}" if number else TABLE_PREFIX
+
+
+def _epoch(ts):
+    # row timestamps are naive UTC
+    if ts is None:
+        return math.nan
+    if not isinstance(ts, datetime):
+        ts = datetime.strptime(ts, TIME_FORMAT)
+    return ts.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _value(v):
+    return math.nan if v is None else float(v)
+
+
+def _optional(v):
+    return None if math.isnan(v) else v
+
+
+class Spool:
+    def __init__(self, path, grow_records=4096):
+        self.path = path
+        self.grow_bytes = grow_records * RECORD.size
+        self.lock = threading.Lock()
+
+        new = not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE
+        self.file = open(path, "w+b" if new else "r+b")
+        if new:
+            self.file.truncate(HEADER_SIZE + self.grow_bytes)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+        if new:
+            self.write_off = self.read_off = HEADER_SIZE
+            self._store_header()
+        else:
+            magic, self.write_off, self.read_off = HEADER.unpack_from(self.mm, 0)
+            if magic != MAGIC:
+                raise RuntimeError(f"{path} is not a readings spool")
+
+    def _store_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, self.write_off, self.read_off)
+
+    def _grow(self):
+        size = len(self.mm) + self.grow_bytes
+        self.mm.close()
+        self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+
+    def __len__(self):
+        with self.lock:
+            return (self.write_off - self.read_off) // RECORD.size
+
+    def append(self, table, row):
+        """
+        Appends one row (db_writer.COLUMNS order) destined for table.
+        """
+        pid, temperature, humidity, wind_speed, soil_moisture, ts = row
+        record = (_epoch(ts), int(pid), table_number(table),
+                  _value(temperature), _value(humidity), _value(wind_speed), _value(soil_moisture))
+
+        with self.lock:
+            if self.write_off + RECORD.size > len(self.mm):
+                self._grow()
+            RECORD.pack_into(self.mm, self.write_off, *record)
+            self.write_off += RECORD.size
+            self._store_header()
+
+    def pending(self, max_records):
+        """
+        Returns up to max_records unsent (table, row) pairs and the offset to
+        pass to commit() once they are safely in the database.
+        """
+        with self.lock:
+            end = min(self.write_off, self.read_off + max_records * RECORD.size)
+            raw = self.mm[self.read_off:end]
+
+        batch = []
+        for ts, pid, number, temperature, humidity, wind_speed, soil_moisture in RECORD.iter_unpack(raw):
+            ts = None if math.isnan(ts) else datetime.utcfromtimestamp(ts)
+            batch.append((table_name(number), (pid, _optional(temperature), _optional(humidity),
+                                               _optional(wind_speed), _optional(soil_moisture), ts)))
+        return batch, end
+
+    def commit(self, offset):
+        with self.lock:
+            self.read_off = offset
+            if self.read_off == self.write_off:
+                # fully drained, start over at the front of the file
+                self.read_off = self.write_off = HEADER_SIZE
+            elif self.read_off - HEADER_SIZE > len(self.mm) // 2:
+                # compact: slide the unsent tail back to the front
+                count = self.write_off - self.read_off
+                self.mm.move(HEADER_SIZE, self.read_off, count)
+                self.read_off = HEADER_SIZE
+                self.write_off = HEADER_SIZE + count
+            self._store_header()
+
+    def flush(self):
+        # push dirty pages to disk, the drain thread calls this every pass
+        with self.lock:
+            self.mm.flush()
+
+    def close(self):
+        with self.lock:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
@@ -1,78 +1,97 @@
 import socket
 import sys
 import types
-import random
 import selectors
-import matplotlib.pyplot as plt
-import numpy as np
 import logging
 import time
-import json
+import wire
+import token_codec
+from scheduler import RoundScheduler
+from membership import Membership
+from readings_store import READINGS_TABLE
 
 #------ for sensor readings ------------
-import board
-import busio
-import time
-from datetime import datetime
-import simpleio
-import adafruit_ads1x15.ads1015 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
-from adafruit_seesaw.seesaw import Seesaw
-import adafruit_sht31d
+import sensors
 import argparse
 # ---------------------------------------
 
-# import mysql DB driver
-import mysql.connector
+# background batched DB writer
+from db_writer import BatchWriter
+from spool import Spool
+
+# round plots are rendered in worker processes so they never hold the token
+import plots
+from render_pool import RenderBusy, RenderPool
 
 #setup logging format style 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',)
 
 class TokenRing:
-    def __init__(self, MY_HOST, MY_PORT, NEXT_HOST, NEXT_PORT, PREV_HOST, PREV_PORT, ID_NUMBER, timeout = 30):
+    def __init__(self, MEMBERSHIP, timeout = 30, simulate = False, db_config = None, token_format = 'json', round_hz = 1.0,
+                 plot_workers = 1, plot_every = 1, plot_keep = 10):
 
         # initialize the selector to detect events
         self.sel = selectors.DefaultSelector()
 
+        # ring membership, successor lookups skip failed nodes
+        self.membership = MEMBERSHIP
+
         # initialize hosts and ports and IDs
-        self.my_host = MY_HOST
-        self.my_port = MY_PORT
-        self.next_host = NEXT_HOST
-        self.next_port = NEXT_PORT
-        self.prev_host = PREV_HOST
-        self.prev_port = PREV_PORT
+        ID_NUMBER = MEMBERSHIP.my_id
+        self.my_host = MEMBERSHIP.me.host
+        self.my_port = MEMBERSHIP.me.port
         self.id_number = ID_NUMBER
 
-        self.BACKUP_INCREMENTER = False
+        # paces rounds at the incrementer (and in solo mode) by deadline
+        self.scheduler = RoundScheduler(round_hz)
+        # the incrementer holds the token for up to one period, a node that waits no longer than
+        # that would declare the token lost every round and inject a duplicate
+        if self.scheduler.period >= timeout:
+            raise ValueError(f"round period {self.scheduler.period:g}s must be shorter than the "
+                             f"{timeout}s failure timeout, raise --round-hz or --timeout")
+
+        # persistent links to neighbours keyed by (host, port), and the token format agreed on each
+        self.links = {}
+        self.link_formats = {}
+        self.link_timeout = 10
+
+        # encoding we ask for when a link opens, the receiver has the final say
+        self.token_format = token_format
+
+        # cached sensor handles, shared for the life of the process
+        self.sensor = sensors.get_driver(simulated=simulate)
+
+        # pooled writer thread, flushes rounds in batches so the ring never waits on MySQL
+        # rows are spooled to disk first and drained into MySQL, so outages don't lose rounds
+        db_config = db_config or {}
+        spool_path = db_config.get('spool', f"P{ID_NUMBER}.spool")
+        self.db_writer = BatchWriter(
+            host=db_config.get('host', '127.0.0.1'),
+            port=db_config.get('port', 3306),
+            user=db_config.get('user', 'root'),
+            password=db_config.get('password', ''),
+            batch_rows=db_config.get('batch_rows', 50),
+            flush_interval=db_config.get('flush_interval', 5.0),
+            spool=Spool(spool_path) if spool_path else None,
+            logger=logging.getLogger(f"(P{ID_NUMBER} db)"))
         
 
 
-        #failure detection vars
-        # creates staggered 5 sec intervals 
-        self.timeout = timeout + (ID_NUMBER-1)*5
-        self.WAITING = False
-        self.START = 0
+        # workers come from a forkserver started in run(), a busy pool just skips that round's plot
+        self.render_pool = RenderPool(workers=plot_workers, max_pending=plot_workers)
+        # plot every Nth round (0 = never) into a rotating set of plot_keep files,
+        # plot_keep 0 keeps only the latest PNG in memory (self.last_plot)
+        self.plot_every = plot_every
+        self.plot_keep = plot_keep
+        self.last_plot = None
 
 
-        #LOGIC to swap round incrementer ROLE
-        # this works since it happens at startup before any reconfigs
-        if self.id_number == 1:
-            self.p3_port = self.prev_port
-        
-        elif self.id_number == 2:
-            self.p3_port = self.next_port
-        
-        else:
-            self.p3_port = self.my_port
-        
 
-        # hard mapping next host and port 
-        self.next_id = (self.id_number % 3) + 1 # keep in bounds of 3
-        self.prev_id = ( (self.id_number + 1) % 3) + 1
-        # this isn't totally neccesary but covers weird edge cases with reconfigs
-        #mapping port to id number for failure logic where we need to remove keys from token
-        self.local_area = {self.next_port: f"P{self.next_id}",
-                           self.prev_port: f"P{self.prev_id}"}
+        #failure detection vars
+        # creates staggered 5 sec intervals by position in the ring
+        self.timeout = timeout + MEMBERSHIP.position()*5
+        self.WAITING = False
+        self.START = 0
         
 
 
@@ -81,7 +100,7 @@ class TokenRing:
         self.logger.setLevel(level=logging.INFO)
 
         #log message 
-        self.logger.info(f"Token Ring initialized.")
+        self.logger.info(f"Token Ring initialized with {len(MEMBERSHIP)} nodes.")
 
     
     #main function 
@@ -89,6 +108,9 @@ class TokenRing:
 
         self.logger.debug("Starting Token Ring Server...")
 
+        self.render_pool.start()
+        self.db_writer.start()
+
         #startup the listening socket
         self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -106,9 +128,9 @@ class TokenRing:
         self.sel.register(self.listen_sock, selectors.EVENT_READ, data=None)
         self.logger.debug("Monitoring set.")
 
-        #if pi #1 start the token ring only happens if id nubnmer 1 
+        #the lowest id in the ring starts the token
         #this need to happen to start the ring and trigger other pis events
-        if(self.id_number == 1):
+        if(self.membership.is_starter()):
             # waits 12 seconds before attempting startup
             # this waits for other PIS to enter the ring
             start_time = 12
@@ -119,7 +141,7 @@ class TokenRing:
             self.logger.info("GO")
             self.create_token()
 
-        #this means we are either P2 or P3 
+        #this means we wait for the token
         else:
             self.WAITING = True
             #started waiting at this time, need to track in case of PI FAILURES
@@ -157,6 +179,9 @@ class TokenRing:
         
         finally:
             self.sel.close()
+            self.close_links()
+            self.db_writer.close()
+            self.render_pool.close()
     
     def accept_wrapper(self, sock):
 
@@ -168,8 +193,8 @@ class TokenRing:
         # non-blocking 
         conn.setblocking(False)
 
-        #creates a dasta object
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
+        #creates a dasta object, inb buffers partial frames until a whole token is in
+        data = types.SimpleNamespace(addr=addr, inb=wire.FrameBuffer(), outb=b"")
 
         #since this is the listening socket
         events = selectors.EVENT_READ
@@ -184,8 +209,7 @@ class TokenRing:
         #only will read from the listening socket since we're not sending out the same sokcet we 
         #read from
         if mask & selectors.EVENT_READ:
-            #read data from socket, increasing buffer size for JSON 
-            recv_data = sock.recv(4096)
+            recv_data = sock.recv(65536)
 
             # if theres no data received
             if not recv_data:
@@ -193,128 +217,87 @@ class TokenRing:
                 sock.close()
                 # skip rest of func
                 return 
-            #append to input buffer (inb)
-            # data.inb += recv_data
-            #will decode byte string and then load back the reg dict not string dict
-            token = json.loads(recv_data.decode())
-            self.process_token(token)
+            #append to input buffer (inb), tokens can span many recv calls
+            data.inb.feed(recv_data)
+            try:
+                frames = data.inb.frames()
+            except wire.FrameError as e:
+                self.logger.error(f"bad frame from {data.addr}: {e}")
+                self.sel.unregister(sock)
+                sock.close()
+                return
+
+            for frame in frames:
+                if token_codec.is_hello(frame):
+                    # a new link asks which token format to use, it waits for the answer before sending tokens
+                    try:
+                        wire.send_frame(sock, token_codec.choose(frame).encode())
+                    except (ValueError, OSError) as e:
+                        self.logger.error(f"token format handshake with {data.addr} failed: {e}")
+                        self.sel.unregister(sock)
+                        sock.close()
+                        return
+                    continue
+                #will decode JSON or binary tokens back to the reg dict, the tag byte says which
+                try:
+                    token = token_codec.decode(frame)
+                except ValueError as e:
+                    # no ACK, the sender sees the link drop and doesn't count the token as delivered
+                    self.logger.error(f"undecodable token from {data.addr}, closing link: {e}")
+                    self.sel.unregister(sock)
+                    sock.close()
+                    return
+                # ACK once the token is ours, the sender is blocked on it and the link stays open for the next token
+                try:
+                    sock.send(wire.ACK)
+                except OSError as e:
+                    self.logger.warning(f"could not ACK token from {data.addr}: {e}")
+                self.process_token(token)
             # self.WAITING = False
-            #clear buffer don't need data anymore
-            # data.inb=b""
-            self.sel.unregister(sock)
-            sock.close()
 
 
     # ------------ WRITING TO DB ----------------------
 
     def insert_to_db(self,token):
 
-        conn = None 
-
-        try:
-            # establishing connection
-            conn = mysql.connector.connect(
-                host = '192.168.0.184', #my ip addr
-                port = 3306, 
-                database = 'piSenseDB',
-                user = 'test_user',
-                password = 'password'
-            )
-            if conn.is_connected():
-                self.logger.info("talking to MySQL database")
-            
-            table_map = {
-                "P1": "sensor_readings1",
-                "P2": "sensor_readings2",
-                "P3": "sensor_readings3",
-            }
-
-
-            # inserting data
-            with conn.cursor() as cursor:
-                # iterates through PI keys
-                for pi_id, table in table_map.items():
-                    # grab value from key in token
-                    data = token.get(pi_id)
-                    if not data:
-                        continue #this will skip DEAD pis, needed for db tables
-
-                    # will skip ROUND_NUMBER and INCREMENTER keys 
-                    # if pi_id not in table_map:
-                    #     continue
-
-                    # table = table_map[pi_id]
-                    # construct the SQL query
-                    sql = f"""
-                        INSERT INTO {table} (PID, temperature, humidity, wind_speed, soil_moisture, timestamp)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                        """
-                    cursor.execute(sql, (
-                        pi_id[1], 
-                        data['SHT30 Temp'],
-                        data['SHT30 Hum'],
-                        data['WIND Speed'],
-                        data['SEESAW Hum'],
-                        data['timestamp']
-                    ))
-                conn.commit()
-                self.logger.info("inserted data to DB")
-
-            
-        except mysql.connector.Error as e:
-            self.logger.error(f"data base ERROR: {e}")
-        
-        finally:
-            if conn is not None and conn.is_connected():
-                conn.close()
+        # queue rows for the background writer, never blocks the token
+        # iterates through live PI ids, every PI shares the readings table keyed by PID
+        for node_id in self.membership.live_ids():
+            # grab value from key in token
+            data = token.get(f"P{node_id}")
+            if not data:
+                continue #this will skip DEAD pis, needed for db tables
+
+            self.db_writer.submit(READINGS_TABLE, (
+                node_id,
+                data['SHT30 Temp'],
+                data['SHT30 Hum'],
+                data['WIND Speed'],
+                data['SEESAW Hum'],
+                data['timestamp']
+            ))
+        self.logger.info("queued data for DB")
 
     # ------------------------------------------------
 
 
     def read_sensor_data(self):
 
-        # timestamping for each PI, will automatically be appended to every token
-        curr_time = datetime.now()
-        timestamp = curr_time.strftime("%Y-%m-%d %H:%M:%S")
+        # timestamping for each PI in UTC like every other collector, will automatically be appended to every token
+        timestamp = sensors.utc_stamp()
 
         try:
 
-            # create the I2C bus
-            i2c = busio.I2C(board.SCL, board.SDA)
-
-            # create the ADS object
-            ads = ADS.ADS1015(i2c)
-
-            # create the analog input channel for the anemometer on ADC pin(2) 
-            chan = AnalogIn(ads, ADS.P2)
-
-            # create the Seesaw object for the soil moisture sensor
-            soil_sensor = Seesaw(i2c, addr=0x36)
-
-            # create the SHT31D object for the temperature and humidity sensor
-            temp_sensor = adafruit_sht31d.SHT31D(i2c)
-
-            # maps the voltage to wind speed via simpleio
-            voltage = chan.voltage
-            if voltage < 0.41:
-                wind_speed = 0
-            else:
-                wind_speed = simpleio.map_range(voltage, 0.4, 2, 0, 32.4)
-            
-            SHT30_temp = temp_sensor.temperature
-            SHT30_hum = temp_sensor.relative_humidity
-            
-            soil_moist = soil_sensor.moisture_read()
-            soil_temp = soil_sensor.get_temp()
+            reading = self.sensor.read()
 
             self.logger.debug("Successfully read from sensors")
 
             sensor_data_dict = {
-                'SHT30 Temp': SHT30_temp,
-                'SHT30 Hum': SHT30_hum,
-                'SEESAW Temp': soil_temp,
-                'SEESAW Hum': soil_moist,
-                'WIND Speed': wind_speed,
+                'SHT30 Temp': reading['temperature'],
+                'SHT30 Hum': reading['humidity'],
+                'SEESAW Temp': reading['soil_temp'],
+                'SEESAW Hum': reading['soil_moisture'],
+                'WIND Speed': reading['wind_speed'],
                 'timestamp': timestamp
             }
 
@@ -362,7 +345,6 @@ class TokenRing:
 
         # debug line
         # self.logger.info(f"token contents: {token.items()}")
-        time.sleep(1)
 
         # grab round num
         round_num = token.get("ROUND_NUMBER",1)
@@ -385,6 +367,12 @@ class TokenRing:
         
         self.last_round = round_num
 
+        # a PI we gave up on is carrying data again, so it rejoined the ring
+        for node_id in list(self.membership.failed):
+            if f"P{node_id}" in token:
+                self.logger.info(f"P{node_id} is back, relinking")
+                self.membership.mark_alive(node_id)
+
         # self.logger.info(f"processing token in ROUND{round_num}")
 
         #****CRITICAL append/overwrite pi data to token dict
@@ -392,21 +380,22 @@ class TokenRing:
 
         self.logger.info(f"P{self.id_number} added to token!")
 
-        # only if we are pi3 do we need to plot
-        if self.id_number == 3 or self.BACKUP_INCREMENTER:
+        # only the last live pi before the ring wraps closes out the round
+        if self.membership.is_incrementer():
             self.logger.info(f"plotting data for ROUND{round_num}")
 
             # self.plotter(token)
 
             # inserting to DB now since END of round 
-            # no need to change logic will happen when ID3 or backup incrementer
+            # whoever is the incrementer does this, so it moves with failures
             self.insert_to_db(token)
 
             token["ROUND_NUMBER"]+=1
-            #issues with plots if no sleep
-            time.sleep(1)
+            # pace rounds by deadline, sleeps only for what's left of the round period
+            self.scheduler.wait()
+            self.logger.info(f"round rate: {self.scheduler.report()}")
 
-        # after we have added data we read to token dict we now sned via next_host and next_port
+        # after we have added data we read to token dict we now send to the next live pi
         self.send_token_processor(token)
 
 
@@ -416,65 +405,44 @@ class TokenRing:
 
 
     def send_token_processor(self, token):
-        # if we failed to send token
-        if(not self.send_token(token, self.next_host, self.next_port)):
-
-            #** check to see if the port that refused is P3 so we can then swap roles accordingly
-            failed_port = self.next_port
-            time.sleep(3)
-            self.logger.warning(f"PI at {self.next_host}:{self.next_port} is down! :(")
+        # walk forward around the ring until someone takes the token,
+        # skipping over any run of failed PIs, not just the next one
+        while not self.membership.alone():
+            target = self.membership.successor()
+            if self.send_token(token, target.host, target.port):
+                return
+
+            self.logger.warning(f"P{target.id} at {target.host}:{target.port} is down! :(")
             self.logger.info("RECONFIGURING topology...")
 
             # ** NEED to remove that key from token now ------
-            failed_pi = self.local_area.get(self.next_port)
-            self.logger.warning(f"Removed {failed_pi} at {self.next_host}:{self.next_port} from token")
-            token.pop(failed_pi,None)
+            self.membership.mark_failed(target.id)
+            token.pop(f"P{target.id}",None)
+            self.logger.warning(f"Removed P{target.id} at {target.host}:{target.port} from token")
             # --------------------------
 
-            time.sleep(2)
-            self.logger.info(f"linking P{self.id_number} to previous PI...")
-
-            # if it failed to send AGAIN will enter this conditional
-            if(not self.send_token(token, self.prev_host, self.prev_port)):
-                time.sleep(1)
-                self.logger.error("BOTH MY NEIGHBORS ARE DOWN MAYDAY!!")
-                time.sleep(1)
-
-                # ONLY ONE WITH TOKEN
-                # ****self.logger.error("closing all operations...")
-                
-                # while loop that just reads the sensor data, connects to db, and plots 
-                # until a disconnect, not handling reconnections** 
-                self.logger.info("CONTINUING OPERATIONS ... (SOLO)")
-                self.logger.info("closing socket/selector...")
-                time.sleep(1)
-                #**critical
-                self.sel.unregister(self.listen_sock)
-                self.listen_sock.close()
-                self.sel.close()
-                #enter solo loop
-                return self.solo_loop(token)
-                
-                    
-                # time.sleep(1.25)
-                # sys.exit(1)
-
-            # successfully sent to new receiver can return
-            else:
-                self.logger.info("UPDATED TOPOLOGY")
-                self.logger.info(f"Now I point to {self.prev_host}:{self.prev_port}")
-                self.next_host = self.prev_host
-                self.next_port = self.prev_port
-
-                if(failed_port == self.p3_port):
-                    # now its guaranteed P2 is incrementer after fail since P1 will never send to P3 and fail
-                    # if it does its the last node and will crash sys or go solo mode
-                    self.logger.info("TRANSFERRING P3's DUTIES")
-                    self.BACKUP_INCREMENTER = True
-                    # self.logger.info(f"P{self.id_number} INCREMENTING ROUND NUMBER")
-                    # token["ROUND_NUMBER"]+=1
-                if hasattr(self, 'last_round'):
-                    self.last_round = 0 
+            if not self.membership.alone():
+                nxt = self.membership.successor()
+                self.logger.info(f"UPDATED TOPOLOGY, now I point to P{nxt.id} at {nxt.host}:{nxt.port}")
+                if self.membership.is_incrementer():
+                    self.logger.info("TAKING OVER ROUND INCREMENTER DUTIES")
+            if hasattr(self, 'last_round'):
+                self.last_round = 0
+
+        self.logger.error("ALL OTHER PIS ARE DOWN MAYDAY!!")
+
+        # ONLY ONE WITH TOKEN
+        # while loop that just reads the sensor data, connects to db, and plots 
+        # until a disconnect, not handling reconnections** 
+        self.logger.info("CONTINUING OPERATIONS ... (SOLO)")
+        self.logger.info("closing socket/selector...")
+        #**critical
+        self.sel.unregister(self.listen_sock)
+        self.listen_sock.close()
+        self.sel.close()
+        self.close_links()
+        #enter solo loop
+        return self.solo_loop(token)
 
     def solo_loop(self,token):
         # restarting the round num
@@ -485,11 +453,9 @@ class TokenRing:
                 self.logger.info("reading sensor data...")
                 data = self.read_sensor_data()
                 token[f"P{self.id_number}"] = data 
-                time.sleep(1)
 
                 self.logger.info("plotting data")
                 self.plotter(token)
-                time.sleep(1)
 
                 token["ROUND_NUMBER"] +=1 
 
@@ -497,119 +463,196 @@ class TokenRing:
                 # chekc if we removed bad keys here
                 self.logger.info(f"token: {token.keys()}")
                 self.insert_to_db(token)
-                time.sleep(1)
 
-                
+                # one round per scheduler period instead of fixed sleeps
+                self.scheduler.wait()
+                self.logger.info(f"round rate: {self.scheduler.report()}")
+
             except KeyboardInterrupt:
                 self.logger.info("closing all operations... no one in ring")
                 break
             except Exception as e:
                 self.logger.info(f"failed with {e}, closing all operations... no one in ring")
                 break
-            finally:
-                time.sleep(1.25)
         
+        self.db_writer.close()
+        self.render_pool.close()
         sys.exit(0)
 
 
 
-    def send_token(self,token,host,port):
+    def open_link(self, host, port):
+        # long-lived link to a neighbour, reused for every token we pass it
+        s = socket.create_connection((host, port), timeout=self.link_timeout)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                #set a timeout of 30 seconds for the socket object
-                s.settimeout(10)
-                #use the cli args for ip and port info *** might need connect_ex()
-                s.connect((host,port))
-                #takes the token dict makes it string and converts to utf-8 to send over TCP
-                token_network_ready = json.dumps(token).encode()
+            # agree on the token format before the first token, the receiver answers with its pick
+            wire.send_frame(s, token_codec.hello(self.token_format))
+            fmt = wire.recv_frame(s).decode(errors='replace')
+            if fmt not in token_codec.FORMATS:
+                raise ConnectionResetError(f"unexpected token format {fmt!r} from {host}:{port}")
+        except BaseException:
+            s.close()
+            raise
+        self.links[(host, port)] = s
+        self.link_formats[(host, port)] = fmt
+        self.logger.info(f"opened link to {host}:{port}, sending {fmt} tokens")
+        return s
+
+    def close_link(self, host, port):
+        s = self.links.pop((host, port), None)
+        self.link_formats.pop((host, port), None)
+        if s is not None:
+            try:
+                s.close()
+            except OSError:
+                pass
 
-                #now we can actually send token over network
-                s.sendall(token_network_ready)
+    def close_links(self):
+        for host, port in list(self.links):
+            self.close_link(host, port)
+
+    def link_alive(self, s):
+        # the receiver only ever writes ACKs, and we've consumed those, so a
+        # readable link means the neighbour hung up or restarted
+        try:
+            # non-blocking peek, a timeout socket would wait out the timeout first
+            s.setblocking(False)
+            return s.recv(1, socket.MSG_PEEK) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            s.settimeout(self.link_timeout)
+
+    def send_token(self,token,host,port):
+        #takes the token dict and packs it in the format agreed for the link to send over TCP
+        encoded = {}
+
+        # one retry on a fresh connection if the cached link turns out to be stale
+        for attempt in range(2):
+            s = self.links.get((host, port))
+            try:
+                if s is not None and not self.link_alive(s):
+                    self.logger.info(f"link to {host}:{port} went stale, reconnecting")
+                    self.close_link(host, port)
+                    s = None
+                if s is None:
+                    s = self.open_link(host, port)
+
+                fmt = self.link_formats[(host, port)]
+                if fmt not in encoded:
+                    encoded[fmt] = token_codec.encode(token, fmt)
+
+                #now we can actually send token over network, length-prefixed so any size decodes
+                wire.send_frame(s, encoded[fmt])
+
+                # wait for the neighbour to acknowledge before letting go of the token
+                if s.recv(1) != wire.ACK:
+                    raise ConnectionResetError("link closed before ACK")
 
                 self.logger.info(f"sent token to {host}:{port}")
                 return True
-            
-        except socket.timeout:
-            self.logger.error("Socket timed out!")
-            return False
-        #will get this if you start PI1 first nothing to connect
-        except ConnectionRefusedError:
-            self.logger.error(f"connection refused from pi at {host}:{port}")
-            return False
+
+            except socket.timeout:
+                self.logger.error("Socket timed out!")
+                self.close_link(host, port)
+                return False
+            #will get this if you start PI1 first nothing to connect
+            except ConnectionRefusedError:
+                self.logger.error(f"connection refused from pi at {host}:{port}")
+                self.close_link(host, port)
+                return False
+            except OSError as e:
+                self.logger.warning(f"link to {host}:{port} failed: {e}")
+                self.close_link(host, port)
+
+        return False
     
 
 
     def plotter(self, token):
         round_num = token["ROUND_NUMBER"]
+        if not self.plot_every or round_num % self.plot_every:
+            return
         data = {}
         for key,value in token.items():
             if key.startswith("P"):
                 data[key] = value
 
-        fig, ax = plt.subplots(2, 2)
-        keys = ["SHT30 Temp", "SHT30 Hum", "SEESAW Hum", "WIND Speed"]
-        titles = ["Temp (C)", "Humidity (%)", "Soil Moisture", "Wind Speed"]
-        axes = [ax[0][0], ax[0][1], ax[1][0], ax[1][1]]
-
-        #should be P1, P2, P3, AVG
-        xlabels = list(data.keys()) + ["AVG"]
-        # self.logger.info(f"X-AXIS {xlabels}")
-        x_position = np.arange(len(xlabels))
-
-        colors = ['blue', 'red', 'green']
-        avg_color = 'black'
-
-        for i, key in enumerate(keys):
-            sensor_data = []
-            for pi in data:
-                #will extract sensor data. data looks like => {'P1': {'SHT30': 24.3C}, ...}
-                sensor_value = data[pi][key]
-                #this list is only for specific pis sensor vlas
-                sensor_data.append(sensor_value)
-            
-            avg = np.mean(sensor_data)
-            sensor_data.append(avg)
-
-            #loop through sensor_data list 
-            for j, val in enumerate(sensor_data):
-
-                # check to see if sensor val or avg
-                if j < len(data):
-                    color = colors[j]
-                
-                else:
-                    color = avg_color
-                #plot sensor value with assigned color
-                axes[i].scatter(x_position[j], val, color=color)
-
-            axes[i].set_title(titles[i])
-            axes[i].set_xticks(x_position, xlabels)
+        # fixed set of files reused round after round so disk use stays bounded
+        filename = None
+        if self.plot_keep:
+            filename = f"token-plot-{(round_num // self.plot_every) % self.plot_keep}.png"
 
-        #make everything fit 
-        plt.tight_layout()
-
-        #save to file will be in cwd unless specifed otherwise
-        filename = f"token-plot-{round_num}.png"
-        plt.savefig(filename)
-        plt.close()
-        self.logger.info(f"saved  plot as {filename}")
+        # hand the figure to a render worker, never wait on it here
+        try:
+            future = self.render_pool.submit(plots.render_token, data, filename)
+        except RenderBusy:
+            self.logger.info(f"plot workers busy, skipping plot for ROUND{round_num}")
+            return
+        future.add_done_callback(self.plot_done)
+
+    def plot_done(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self.plot_keep:
+            self.logger.info(f"saved  plot as {future.result()}")
+        else:
+            self.last_plot = future.result()
 
 
 if __name__ == '__main__':
     #added command line args with argparser lib
     parser = argparse.ArgumentParser(description="Token Ring")
     parser.add_argument('--my-host', default='127.0.0.1', help ='host address for pi')
-    parser.add_argument('--my-port', type=int, required=True, help="port for pi")
+    parser.add_argument('--ring-config', default=None, help='JSON file listing every node in the ring (replaces --my/--next/--prev)')
+    parser.add_argument('--my-port', type=int, help="port for pi")
     parser.add_argument('--next-host', default='127.0.0.1', help ='host address for next pi')
-    parser.add_argument('--next-port', type=int, required=True, help="port for next pi")
+    parser.add_argument('--next-port', type=int, help="port for next pi")
     parser.add_argument('--prev-host', default = '127.0.0.1',help='host address for the previous pi')
-    parser.add_argument('--prev-port', type=int, required=True ,help='port for the previous pi')
+    parser.add_argument('--prev-port', type=int ,help='port for the previous pi')
     parser.add_argument('--id', type=int, required=True, help ='pi ID')
     parser.add_argument('--timeout', type=int, default=30, help='timeout to detect offline pi')
+    parser.add_argument('--simulate', action='store_true', help='use simulated sensors instead of the I2C bus')
+    parser.add_argument('--db-host', default='127.0.0.1', help='host address for the MySQL database')
+    parser.add_argument('--db-port', type=int, default=3306, help='port for the MySQL database')
+    parser.add_argument('--db-user', default='root', help='user for the MySQL database')
+    parser.add_argument('--db-pass', default='', help='password for the MySQL database user')
+    parser.add_argument('--db-batch', type=int, default=50, help='flush to the DB once this many rows are queued')
+    parser.add_argument('--db-flush', type=float, default=5.0, help='flush to the DB at least every N seconds')
+    parser.add_argument('--round-hz', type=float, default=1.0, help='target rounds per second around the ring, one round must take less than --timeout')
+    parser.add_argument('--token-format', choices=token_codec.FORMATS, default='json', help='encoding this pi asks for on each link it opens, falls back to json')
+    parser.add_argument('--plot-workers', type=int, default=1, help='processes rendering round plots off the token path')
+    parser.add_argument('--plot-every', type=int, default=1, help='plot every Nth round, 0 turns plotting off')
+    parser.add_argument('--plot-keep', type=int, default=10, help="number of rotating plot files, 0 keeps the latest plot in memory only")
+    parser.add_argument('--spool', default=None, help="file readings are spooled to before the DB (default P<id>.spool, '' to disable)")
     args = parser.parse_args()
-
-    token_ring = TokenRing(MY_HOST=args.my_host, MY_PORT=args.my_port, NEXT_HOST=args.next_host, NEXT_PORT =args.next_port,
-                           PREV_HOST=args.prev_host, PREV_PORT=args.prev_port, ID_NUMBER=args.id,timeout=args.timeout)
+    if args.round_hz <= 0:
+        parser.error("--round-hz must be positive")
+    if 1.0 / args.round_hz >= args.timeout:
+        parser.error(f"--round-hz {args.round_hz:g} gives a {1.0 / args.round_hz:g}s round, "
+                     f"which must be shorter than --timeout {args.timeout}s")
+
+    # membership comes from the ring config, or the classic 3-node neighbour args
+    if args.ring_config:
+        membership = Membership.load(args.ring_config, args.id)
+    else:
+        if None in (args.my_port, args.next_port, args.prev_port):
+            parser.error("--my-port, --next-port and --prev-port are required without --ring-config")
+        membership = Membership.from_neighbours(args.id, args.my_host, args.my_port, args.next_host, args.next_port,
+                                                args.prev_host, args.prev_port)
+
+    token_ring = TokenRing(MEMBERSHIP=membership, timeout=args.timeout,
+                           simulate=args.simulate, token_format=args.token_format,
+                           round_hz=args.round_hz, plot_workers=args.plot_workers,
+                           plot_every=args.plot_every, plot_keep=args.plot_keep,
+                           db_config={'host': args.db_host, 'port': args.db_port, 'user': args.db_user,
+                                      'password': args.db_pass, 'batch_rows': args.db_batch,
+                                      'flush_interval': args.db_flush,
+                                      'spool': args.spool if args.spool is not None else f"P{args.id}.spool"})
 
     token_ring.run()
 
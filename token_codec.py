@@ -0,0 +1,174 @@
+# Token encodings for the token ring.
+#
+# JSON is the original format. The binary format packs the same token
+# into fixed struct records: a header with a version byte, round number
+# and incrementer flag, then one record per Pi with float64 readings (the
+# same values JSON carries, nothing rounded) and an epoch-second timestamp.
+#
+# Nothing is guessed from the payload. A sender opens every link with a
+# hello listing the formats it would like to send, best first, and the
+# receiver answers with the one to use. Every token then starts with a tag
+# byte naming its format, so a token the binary layout can't hold can still
+# go out as JSON on a binary link.
+
+import argparse
+import functools
+import json
+import struct
+import time
+from datetime import datetime, timezone
+
+VERSION = 2
+
+# version | incrementer flag | round number | number of Pi records
+HEADER = struct.Struct("<BBIH")
+# Pi id | SHT30 Temp | SHT30 Hum | SEESAW Temp | SEESAW Hum | WIND Speed | epoch timestamp
+PI_RECORD = struct.Struct("<H5dI")
+
+FIELDS = ('SHT30 Temp', 'SHT30 Hum', 'SEESAW Temp', 'SEESAW Hum', 'WIND Speed')
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+FORMATS = ('json', 'binary')
+# first byte of every encoded token
+TAGS = {'json': b'J', 'binary': b'B'}
+
+# link handshake, b'HELLO binary json' from the sender, the chosen format name back
+HELLO = b'HELLO '
+
+
+# timestamp conversion dominates the binary path. TIME_FORMAT is ISO 8601,
+# so the C fromisoformat/isoformat do it instead of strptime/strftime, and
+# stamps repeated within a round (a Pi that missed a sample) hit the cache
+@functools.lru_cache(maxsize=256)
+def _to_epoch(stamp):
+    # stamps are naive UTC
+    return int(datetime.fromisoformat(stamp).replace(tzinfo=timezone.utc).timestamp())
+
+
+@functools.lru_cache(maxsize=256)
+def _from_epoch(ts):
+    return datetime.utcfromtimestamp(ts).isoformat(sep=' ')
+
+
+def hello(preferred):
+    # JSON is always offered last so any receiver can accept something
+    return HELLO + ' '.join(dict.fromkeys((preferred, 'json'))).encode()
+
+
+def is_hello(payload):
+    return payload.startswith(HELLO)
+
+
+def choose(payload, accepted=FORMATS):
+    """
+    Receiver side of the handshake: the first format offered in payload
+    that we accept.
+    """
+    for fmt in payload[len(HELLO):].decode(errors='replace').split():
+        if fmt in accepted:
+            return fmt
+    raise ValueError(f"no common token format in {payload!r}")
+
+
+def encode_json(token):
+    return json.dumps(token).encode()
+
+
+def encode_binary(token):
+    """
+    Packs a token. Raises ValueError for keys the fixed layout can't carry.
+    """
+    pis = []
+    for key, value in token.items():
+        if key in ('ROUND_NUMBER', 'INCREMENTER'):
+            continue
+        if not (key.startswith("P") and key[1:].isdigit()):
+            raise ValueError(f"binary token has no slot for {key}")
+        pis.append((int(key[1:]), value))
+
+    out = bytearray(HEADER.size + PI_RECORD.size * len(pis))
+    HEADER.pack_into(out, 0, VERSION, bool(token.get('INCREMENTER', False)),
+                     token.get('ROUND_NUMBER', 1), len(pis))
+
+    offset = HEADER.size
+    for pi_id, data in pis:
+        PI_RECORD.pack_into(out, offset, pi_id, *(data[field] for field in FIELDS), _to_epoch(data['timestamp']))
+        offset += PI_RECORD.size
+    return bytes(out)
+
+
+def decode_binary(payload, offset=0):
+    version, incrementer, round_num, count = HEADER.unpack_from(payload, offset)
+    if version != VERSION:
+        raise ValueError(f"unsupported token version {version}")
+
+    token = {}
+    start = offset + HEADER.size
+    records = memoryview(payload)[start:start + count * PI_RECORD.size]
+    for pi_id, temp, hum, soil_temp, soil_hum, wind, ts in PI_RECORD.iter_unpack(records):
+        token[f"P{pi_id}"] = {'SHT30 Temp': temp, 'SHT30 Hum': hum, 'SEESAW Temp': soil_temp,
+                              'SEESAW Hum': soil_hum, 'WIND Speed': wind, 'timestamp': _from_epoch(ts)}
+
+    token['ROUND_NUMBER'] = round_num
+    token['INCREMENTER'] = bool(incrementer)
+    return token
+
+
+def encode(token, fmt='json'):
+    if fmt == 'binary':
+        try:
+            return TAGS['binary'] + encode_binary(token)
+        except (ValueError, KeyError, TypeError, struct.error):
+            # anything the fixed layout can't hold still goes out as JSON
+            pass
+    return TAGS['json'] + encode_json(token)
+
+
+def decode(payload):
+    """
+    Token dict from an encoded payload. Raises ValueError for anything
+    that isn't a well-formed token.
+    """
+    tag = payload[:1]
+    if tag == TAGS['json']:
+        return json.loads(payload[1:])
+    if tag == TAGS['binary']:
+        try:
+            return decode_binary(payload, 1)
+        except struct.error as e:
+            raise ValueError(f"truncated binary token: {e}") from e
+    raise ValueError(f"unknown token format tag {tag!r}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare JSON and binary token encodings")
+    parser.add_argument('--pis', type=int, default=3, help='number of Pis in the benchmark token')
+    parser.add_argument('--iterations', type=int, default=20000, help='encode/decode iterations per format')
+    args = parser.parse_args()
+
+    # a distinct timestamp per iteration, like successive rounds, so the epoch caches never hit
+    now = int(time.time())
+    tokens = []
+    for n in range(args.iterations):
+        stamp = _from_epoch.__wrapped__(now + n)
+        token = {f"P{i}": {'SHT30 Temp': 21.5 + i, 'SHT30 Hum': 48.25, 'SEESAW Temp': 19.75,
+                           'SEESAW Hum': 512, 'WIND Speed': 3.5, 'timestamp': stamp}
+                 for i in range(1, args.pis + 1)}
+        token['ROUND_NUMBER'] = 42
+        token['INCREMENTER'] = False
+        tokens.append(token)
+
+    for fmt in FORMATS:
+        _to_epoch.cache_clear()
+        _from_epoch.cache_clear()
+
+        start = time.perf_counter()
+        payloads = [encode(token, fmt) for token in tokens]
+        enc = (time.perf_counter() - start) / args.iterations
+
+        start = time.perf_counter()
+        for payload in payloads:
+            decode(payload)
+        dec = (time.perf_counter() - start) / args.iterations
+
+        print(f"{fmt:>6}: {len(payloads[0]):5d} bytes  encode {enc * 1e6:7.2f} us  decode {dec * 1e6:7.2f} us")
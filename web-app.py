@@ -1,79 +1,338 @@
-from flask import Flask, render_template, send_file
+from flask import Flask, Response, jsonify, render_template, request
 import mysql.connector
-from datetime import datetime, timedelta
-import matplotlib
-# prevents Mac OS GUI pop-up error
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from datetime import datetime, timedelta, timezone
 import pandas as pd
-import io
-import requests
+import functools
+import hashlib
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from collections import OrderedDict
+import os
+from forecast import ForecastCache, OpenMeteoSource, StubSource
+from series_cache import COLUMNS, SeriesCache
+from rollups import MEASURES, RollupJob, downsample, fetch_rollup, pick_resolution
+from plots import RESAMPLE, render_downsampled, render_plot
+from render_pool import RenderBusy, RenderPool
 
 app = Flask(__name__)
 
-def fetch_sensor_data():
-    db = mysql.connector.connect(user='root', password='', host='127.0.0.1', database='piSenseDB')
-    cursor = db.cursor()
-    since = datetime.utcnow() - timedelta(days=1)
-    all_rows = []
-    for i in (1, 2, 3):
-        cursor.execute(f"""
-            SELECT PID, temperature, humidity, wind_speed, soil_moisture, timestamp
-            FROM sensor_readings{i} WHERE timestamp >= %s
-        """, (since,))
-        all_rows += cursor.fetchall()
-    cursor.close()
-    db.close()
-    return all_rows
+DB_CONFIG = {'user': 'root', 'password': '', 'host': '127.0.0.1', 'database': 'piSenseDB'}
+
+# one shared cache for every measure, plots only pay for rows newer than the last refresh
+series = SeriesCache(DB_CONFIG)
+
+# seconds a request waits on its render before giving up with a 503
+RENDER_TIMEOUT = 30
+
+# render workers import this script again as __mp_main__, only the app itself starts pools and threads
+if multiprocessing.current_process().name == 'MainProcess':
+    # matplotlib runs in worker processes
+    render_pool = RenderPool().start()
+
+    # keeps the 1m/15m/1h rollup tables current for ranges longer than the cache window
+    rollup_job = RollupJob(DB_CONFIG).start()
+
+# whole hourly series cached and refreshed in the background, set FORECAST_STUB=1 to run offline
+forecast = ForecastCache(StubSource() if os.environ.get('FORECAST_STUB') else OpenMeteoSource())
 
 def fetch_forecast():
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        'latitude': 36.97,
-        'longitude': -122.03,
-        'hourly': 'temperature_2m,relativehumidity_2m,wind_speed_10m'
-    }
-    r = requests.get(url, params=params)
-    data = r.json()['hourly']
-    return {
-        'temperature': data['temperature_2m'][0],
-        'humidity': data['relativehumidity_2m'][0],
-        'wind_speed': data['wind_speed_10m'][0]
-    }
+    # values for the current hour, never waits on Open-Meteo once the first fetch is in
+    return forecast.current()
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+class PlotCache:
+    """
+    Size-bounded LRU of rendered PNGs. Keys carry everything the image
+    depends on, so an entry never needs invalidating, it just ages out.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def etag(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            png = self.entries.get(key)
+            if png is not None:
+                self.entries.move_to_end(key)
+            return png
+
+    def stale(self, key):
+        # newest image of the same view (measure, days, rule) whatever its version
+        with self.lock:
+            for k in reversed(self.entries):
+                if k[:3] == key[:3]:
+                    return self.entries[k]
+            return None
+
+    def put(self, key, png):
+        with self.lock:
+            self.entries[key] = png
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+plot_cache = PlotCache()
+
+class Broadcaster:
+    """
+    Fans new readings out to every /stream client. One poller thread
+    refreshes the shared series cache and encodes each delta once, then
+    every subscriber queue gets the same string, so viewers add no DB load.
+    """
+    def __init__(self, series, interval=1.0, max_queued=64):
+        self.series = series
+        self.interval = interval
+        # deltas a client may fall behind by before it is dropped (EventSource reconnects)
+        self.max_queued = max_queued
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self):
+        q = queue.Queue(self.max_queued)
+        with self.lock:
+            self.subscribers.add(q)
+            # poll only once someone is watching, and start it again if it ever died
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name="stream-poller", daemon=True)
+                self.thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, msg):
+        with self.lock:
+            for q in list(self.subscribers):
+                try:
+                    q.put_nowait(msg)
+                except queue.Full:
+                    self.subscribers.discard(q)
+                    # wake the slow client's generator so it hangs up, draining through the
+                    # queue's own locking since the generator may be reading it right now
+                    try:
+                        while True:
+                            q.get_nowait()
+                    except queue.Empty:
+                        pass
+                    try:
+                        q.put_nowait(None)
+                    except queue.Full:
+                        pass
+
+    @staticmethod
+    def encode(df):
+        # column-oriented delta, epochs and 2 decimals keep it small, NaN goes out as null
+        out = {'t': df['time'].to_numpy().astype('datetime64[s]').astype('int64').tolist(),
+               'pid': df['PID'].tolist()}
+        for m in MEASURES:
+            out[m] = [None if v != v else round(v, 2) for v in df[m].tolist()]
+        return json.dumps(out, separators=(',', ':'))
+
+    def _loop(self):
+        seq = None
+        while True:
+            try:
+                self.series.refresh()
+                df, seq = self.series.since(seq)
+                if df is not None and len(df):
+                    self.publish(self.encode(df))
+            except mysql.connector.Error as e:
+                app.logger.warning(f"stream poll failed: {e}")
+            except Exception:
+                # anything else (bad row, encode bug) must not take the poller down for good
+                app.logger.exception("stream poll failed")
+            time.sleep(self.interval)
+
+broadcaster = Broadcaster(series)
+
+def load_rollup(table, since):
+    with mysql.connector.connect(**DB_CONFIG) as db:
+        with db.cursor() as cursor:
+            rows = fetch_rollup(cursor, table, since)
+    df = pd.DataFrame.from_records(rows, columns=COLUMNS)
+    df['time'] = pd.to_datetime(df['time'])
+    return df
+
+def parse_time(value, default):
+    # accepts epoch seconds or ISO 8601, everything is naive UTC like the rest of the app
+    if value is None:
+        return default
+    try:
+        epoch = float(value)
+    except ValueError:
+        ts = datetime.fromisoformat(value)
+        if ts.tzinfo is not None:
+            # 'Z' or an explicit offset, bring it to naive UTC
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        return ts
+    try:
+        return datetime.utcfromtimestamp(epoch)
+    except (OverflowError, OSError, ValueError):
+        raise ValueError(f"{value} is out of range for a timestamp")
+
+def parse_range():
+    """
+    from/to/points query args, to defaults to now and from to a day before it.
+    Raises ValueError on bad input.
+    """
+    until = parse_time(request.args.get('to'), datetime.utcnow())
+    try:
+        since = parse_time(request.args.get('from'), until - timedelta(days=1))
+    except OverflowError:
+        raise ValueError("to is too early to default from")
+    points = int(request.args.get('points', 500))
+    if since >= until:
+        raise ValueError("from must be before to")
+    if not 1 <= points <= 10000:
+        raise ValueError("points must be between 1 and 10000")
+    return since, until, points
+
+def load_downsampled(measure, since, until, points):
+    # UTC session so the SQL buckets line up with rollups.floor_time
+    with mysql.connector.connect(**{**DB_CONFIG, 'time_zone': '+00:00'}) as db:
+        with db.cursor() as cursor:
+            return downsample(cursor, measure, since, until, points)
+
 @app.route('/plot/<measure>')
 def plot_measure(measure):
-    rows = fetch_sensor_data()
-    df = pd.DataFrame(rows, columns=['PID', 'temperature', 'humidity', 'wind_speed', 'soil_moisture', 'time'])
-    df['time'] = pd.to_datetime(df['time'])
-    # ***alter this line for sampling duration
-    pivot = df.pivot_table(index='time', columns='PID', values=measure).resample('15s').mean()
-    avg = pivot.mean(axis=1)
+    if measure not in MEASURES:
+        return Response(f"unknown measure {measure}\n", status=404)
+    days = request.args.get('days', default=1, type=int)
+    if days < 1:
+        return Response("days must be at least 1\n", status=400)
     forecast = fetch_forecast().get(measure, None)
 
-    fig, ax = plt.subplots()
-    for col in pivot.columns:
-        ax.plot(pivot.index, pivot[col], alpha=0.3, label=f'Pi {col}')
-    ax.plot(avg.index, avg, linewidth=2, label='Average')
-    if forecast is not None:
-        ax.axhline(forecast, linestyle='--', color='red', label='Forecast')
-    # ax.set_title(measure.replace('_', ' ').title())
-    ax.legend()
-    ax.set_xlabel("Time")
-    ax.set_ylabel(measure.title())
-    fig.autofmt_xdate(rotation=90)
-
-    buf = io.BytesIO()
-    fig.savefig(buf, format='png')
-    plt.close(fig)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/png')
+    if {'from', 'to', 'points'} & set(request.args):
+        # explicit range, downsampled in SQL to at most `points` per PID
+        try:
+            since, until, points = parse_range()
+        except ValueError as e:
+            return Response(f"{e}\n", status=400)
+        series.refresh()
+        # keyed on the raw args so an open-ended range still revalidates until new data lands
+        rule = (request.args.get('from'), request.args.get('to'), points)
+        version = (series.version(), rollup_job.watermark)
+        load = lambda: load_downsampled(measure, since, until, points)[1]
+        render = render_downsampled
+    elif days == 1:
+        # one day is served straight from the raw series cache
+        series.refresh()
+        rule, version = RESAMPLE, series.version()
+        # only this measure's columns cross to the render worker
+        load = lambda: series.snapshot()[['PID', 'time', measure]]
+        render = functools.partial(render_plot, rule=RESAMPLE)
+    else:
+        # longer ranges read the coarsest rollup needed to stay under the point budget
+        since = datetime.utcnow() - timedelta(days=days)
+        seconds, table = pick_resolution(timedelta(days=days))
+        rule, version = f'{seconds}s', rollup_job.watermark
+        load = lambda: load_rollup(table, since)[['PID', 'time', measure]]
+        render = functools.partial(render_plot, rule=f'{seconds}s')
 
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6500)
+    # the image only changes when new data lands or the forecast moves
+    key = (measure, days, rule, version, forecast)
+    etag = PlotCache.etag(key)
+    if etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        png = plot_cache.get(key)
+        if png is None:
+            try:
+                png = render_pool.submit(render, load(), measure, forecast).result(timeout=RENDER_TIMEOUT)
+            except (RenderBusy, TimeoutError):
+                # shed load: the last image of this view if we have one, otherwise ask the client to retry
+                png = plot_cache.stale(key)
+                if png is None:
+                    resp = Response("renderer busy, try again shortly\n", status=503)
+                    resp.headers['Retry-After'] = '2'
+                    return resp
+                resp = Response(png, mimetype='image/png')
+                resp.cache_control.no_cache = True
+                return resp
+            plot_cache.put(key, png)
+        resp = Response(png, mimetype='image/png')
+
+    resp.set_etag(etag)
+    # browsers must revalidate, which is a cheap 304 while nothing has changed
+    resp.cache_control.no_cache = True
+    return resp
 
+@app.route('/series/<measure>')
+def series_measure(measure):
+    """
+    JSON series for measure over ?from=&to=, at most ?points= samples per PID:
+    {"bucket": seconds, "series": {PID: {"t": [epoch], "mean": [], "min": [], "max": []}}}
+
+    Buckets of a minute or more come from the rollup tables: the first bucket
+    starts at or before from, and the newest minute or so (up to one RollupJob
+    interval) is missing until the next rollup pass.
+    """
+    if measure not in MEASURES:
+        return jsonify(error=f"unknown measure {measure}"), 404
+    try:
+        since, until, points = parse_range()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    bucket, rows = load_downsampled(measure, since, until, points)
+    out = {}
+    for pid, t, mean, lo, hi in rows:
+        s = out.setdefault(str(pid), {'t': [], 'mean': [], 'min': [], 'max': []})
+        s['t'].append(int(t.replace(tzinfo=timezone.utc).timestamp()))
+        s['mean'].append(round(float(mean), 3) if mean is not None else None)
+        s['min'].append(lo)
+        s['max'].append(hi)
+
+    return jsonify(measure=measure, bucket=bucket,
+                   **{'from': since.isoformat(), 'to': until.isoformat()}, series=out)
+
+@app.route('/stream')
+def stream():
+    """
+    Server-sent events of new readings as they reach the database. Each
+    event is {"t": [epoch], "pid": [], "temperature": [], ...} for the rows
+    since the previous one, starting with the newest reading per PID.
+    """
+    series.refresh()
+    df = series.snapshot()
+    first = Broadcaster.encode(df.groupby('PID').tail(1)) if len(df) else None
+    q = broadcaster.subscribe()
+
+    def events():
+        try:
+            yield "retry: 2000\n\n"
+            if first is not None:
+                yield f"data: {first}\n\n"
+            while True:
+                try:
+                    msg = q.get(timeout=15)
+                except queue.Empty:
+                    # comment line keeps proxies from timing out an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                if msg is None:
+                    return
+                yield f"data: {msg}\n\n"
+        finally:
+            broadcaster.unsubscribe(q)
+
+    resp = Response(events(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=6500, threaded=True)
@@ -0,0 +1,94 @@
+# Wire protocol shared by the polling peers and the token ring.
+#
+# Every message is a frame: a 4-byte big-endian payload length followed
+# by the payload. Frames can be any size and survive TCP splitting or
+# coalescing segments, unlike a single recv() of a fixed buffer.
+
+import struct
+
+HEADER = struct.Struct("!I")
+
+# one byte sent back per frame on links that acknowledge delivery
+ACK = b"\x06"
+
+# refuse absurd lengths from a corrupt or hostile stream
+MAX_FRAME = 16 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode(payload: bytes) -> bytes:
+    if len(payload) > MAX_FRAME:
+        raise FrameError(f"frame of {len(payload)} bytes exceeds {MAX_FRAME}")
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameBuffer:
+    """
+    Incremental decoder. feed() whatever recv() returned and pull complete
+    payloads out of frames().
+
+    Bytes are appended to one bytearray and consumed by offset, the front is
+    only trimmed once per frames() pass, so nothing is re-copied per recv.
+    """
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def feed(self, data):
+        self.buf += data
+
+    def frames(self):
+        out = []
+        buf = self.buf
+        while len(buf) - self.pos >= HEADER.size:
+            (length,) = HEADER.unpack_from(buf, self.pos)
+            if length > MAX_FRAME:
+                raise FrameError(f"frame of {length} bytes exceeds {MAX_FRAME}")
+            start = self.pos + HEADER.size
+            end = start + length
+            if end > len(buf):
+                break
+            out.append(bytes(buf[start:end]))
+            self.pos = end
+
+        if self.pos:
+            del buf[:self.pos]
+            self.pos = 0
+        return out
+
+
+def send_frame(sock, payload: bytes):
+    sock.sendall(encode(payload))
+
+
+def recv_frame(sock):
+    # blocking socket version, for the odd synchronous exchange such as a handshake
+    header = _recv_exactly(sock, HEADER.size)
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise FrameError(f"frame of {length} bytes exceeds {MAX_FRAME}")
+    return _recv_exactly(sock, length)
+
+
+def _recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionResetError("connection closed mid-frame")
+        buf += chunk
+    return bytes(buf)
+
+
+async def read_frame(reader):
+    # asyncio.StreamReader version, raises IncompleteReadError on EOF
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_FRAME:
+        raise FrameError(f"frame of {length} bytes exceeds {MAX_FRAME}")
+    return await reader.readexactly(length)